@@ -7,9 +7,10 @@ import plotly.express as px
 import plotly.graph_objs as go
 from plotly.subplots import make_subplots
 import numpy as np
+from functions_stockage import load_table
 
 # Charger les données
-df = pd.read_csv("./data_final/tableaux/df_pixel_filtre_dept10.csv")
+df = load_table("./data_final/tableaux/df_pixel_filtre_dept10", schema=True)  # Parquet s'il existe, sinon CSV ; types compacts
 
 # Pré-traitement des données
 df['date'] = pd.to_datetime(df['date'].astype(str),
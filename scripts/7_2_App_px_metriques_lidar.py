@@ -9,9 +9,10 @@ import plotly.express as px
 import plotly.graph_objs as go
 from plotly.subplots import make_subplots
 import numpy as np
+from functions_stockage import load_table
 
 # Chargement et préparation des données
-df = pd.read_csv("./data_final/tableaux/df_pixel_filtre_lidar.csv")
+df = load_table("./data_final/tableaux/df_pixel_filtre_lidar", schema=True)  # Parquet s'il existe, sinon CSV ; types compacts
 df['date'] = pd.to_datetime(df['date'].astype(str),
                             errors='coerce', format='%Y')
 df['year'] = df['date'].dt.year
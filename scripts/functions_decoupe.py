@@ -1,12 +1,26 @@
 # Importation des bibliothèques nécessaires
+import hashlib
+import json
 import os
-import subprocess
+import threading
+import time
+import traceback
+import xml.etree.ElementTree as ET
+from contextlib import ExitStack
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 import geopandas as gpd
 import numpy as np
 import rasterio
 from rasterio.mask import mask
+from rasterio.shutil import copy as rio_copy
+from rasterio.dtypes import dtype_rev, typename_fwd
 from rasterio.enums import Resampling
-from rasterio.warp import reproject
+from rasterio.features import geometry_mask, geometry_window
+from rasterio.vrt import WarpedVRT
+from rasterio.errors import WindowError
+from rasterio.windows import Window
+from shapely.geometry import box
+from functions_nettoyage import normaliser_geometries
 
 
 # * ======================================= * #
@@ -66,8 +80,7 @@ def create_vrt(base_dir, zone, annees, raster_type, output_dir, rasters=None):
         os.makedirs(output_dir, exist_ok=True)
         vrt_output_path = os.path.join(
             output_dir, f'{raster_type}_stack_{zone}.vrt')
-        gdal_command = ['gdalbuildvrt', '-separate', vrt_output_path] + rasters
-        subprocess.run(gdal_command)
+        build_separate_vrt(rasters, vrt_output_path)
         print(f'VRT créé à : {vrt_output_path}')
         return vrt_output_path
     else:
@@ -75,7 +88,285 @@ def create_vrt(base_dir, zone, annees, raster_type, output_dir, rasters=None):
         return None
 
 
-def clip_raster(raster_path, gpkg_path, output_dir, output_name, nodata_value, dtype_value):
+def build_separate_vrt(rasters, vrt_output_path):
+    """
+    Écrit un VRT empilant la première bande de chaque raster (équivalent de
+    `gdalbuildvrt -separate`), sans lancer de sous-processus.
+
+    Tous les rasters doivent partager la même grille (CRS, transform, dimensions).
+    Le fichier est écrit dans un fichier temporaire puis renommé, la fonction peut donc
+    être appelée en parallèle depuis plusieurs threads.
+
+    Args:
+        rasters (list): Chemins des rasters à empiler, dans l'ordre des bandes.
+        vrt_output_path (str): Chemin du VRT à créer.
+
+    Returns:
+        str: Chemin du VRT créé.
+    """
+    vrt_dir = os.path.dirname(os.path.abspath(vrt_output_path))
+    reference = None
+    root = None
+
+    for band, raster in enumerate(rasters, start=1):
+        with rasterio.open(raster) as src:
+            grid = (src.crs, src.transform, src.width, src.height)
+            if reference is None:
+                reference = grid
+                root = ET.Element('VRTDataset', rasterXSize=str(src.width),
+                                  rasterYSize=str(src.height))
+                if src.crs:
+                    ET.SubElement(root, 'SRS').text = src.crs.to_wkt()
+                ET.SubElement(root, 'GeoTransform').text = ', '.join(
+                    repr(v) for v in src.transform.to_gdal())
+            elif grid[0] != reference[0] or grid[2:] != reference[2:] \
+                    or not grid[1].almost_equals(reference[1]):
+                raise ValueError(
+                    f"Le raster {raster} n'a pas la même grille/CRS que {rasters[0]}.")
+
+            data_type = typename_fwd[dtype_rev[src.dtypes[0]]]
+            block_y, block_x = src.block_shapes[0]
+            nodata = src.nodata
+
+        # Bande du VRT : source simple, ou complexe si une valeur NoData est définie
+        vrt_band = ET.SubElement(root, 'VRTRasterBand', dataType=data_type, band=str(band))
+        if nodata is not None:
+            ET.SubElement(vrt_band, 'NoDataValue').text = repr(nodata)
+        source = ET.SubElement(
+            vrt_band, 'ComplexSource' if nodata is not None else 'SimpleSource')
+        ET.SubElement(source, 'SourceFilename', relativeToVRT='1').text = \
+            os.path.relpath(os.path.abspath(raster), vrt_dir).replace(os.sep, '/')
+        ET.SubElement(source, 'SourceBand').text = '1'
+        ET.SubElement(source, 'SourceProperties', RasterXSize=str(reference[2]),
+                      RasterYSize=str(reference[3]), DataType=data_type,
+                      BlockXSize=str(block_x), BlockYSize=str(block_y))
+        rect = {'xOff': '0', 'yOff': '0',
+                'xSize': str(reference[2]), 'ySize': str(reference[3])}
+        ET.SubElement(source, 'SrcRect', **rect)
+        ET.SubElement(source, 'DstRect', **rect)
+        if nodata is not None:
+            ET.SubElement(source, 'NODATA').text = repr(nodata)
+
+    if root is None:
+        raise ValueError("Aucun raster fourni pour créer le VRT.")
+
+    # Écriture atomique : fichier temporaire propre au thread puis renommage
+    tmp_path = f'{vrt_output_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    ET.ElementTree(root).write(tmp_path, encoding='utf-8')
+    os.replace(tmp_path, vrt_output_path)
+    return vrt_output_path
+
+
+# Profils de sortie des GeoTIFF : 'lzw' reproduit le format historique (bandes LZW),
+# 'tiled' écrit des tuiles compressées avec prédicteur et aperçus internes, 'cog'
+# produit en plus un Cloud-Optimized GeoTIFF (pilote COG de GDAL)
+OUTPUT_PROFILES = {
+    'lzw': {'tiled': False, 'compress': 'LZW', 'predictor': False, 'overviews': False, 'cog': False},
+    'tiled': {'tiled': True, 'compress': 'ZSTD', 'predictor': True, 'overviews': True, 'cog': False},
+    'cog': {'tiled': True, 'compress': 'ZSTD', 'predictor': True, 'overviews': True, 'cog': True},
+    'cog_deflate': {'tiled': True, 'compress': 'DEFLATE', 'predictor': True, 'overviews': True,
+                    'cog': True},
+}
+
+# Taille des tuiles (pixels) des profils tuilés
+TILE_SIZE = 512
+
+
+def _resolve_profile(output_profile):
+    """
+    Retourne la définition d'un profil de sortie à partir de son nom ou d'un dictionnaire.
+
+    Args:
+        output_profile (str ou dict): Nom d'un profil de `OUTPUT_PROFILES`, ou dictionnaire
+            complétant le profil 'lzw' (ex: {'tiled': True, 'compress': 'DEFLATE'}).
+
+    Returns:
+        dict: Profil complet.
+    """
+    if isinstance(output_profile, dict):
+        return {**OUTPUT_PROFILES['lzw'], **output_profile}
+    if output_profile not in OUTPUT_PROFILES:
+        raise ValueError(
+            f"Profil de sortie inconnu : {output_profile} (choix : {list(OUTPUT_PROFILES)}).")
+    return OUTPUT_PROFILES[output_profile]
+
+
+def _creation_options(profile, dtype):
+    """
+    Construit les options de création GTiff d'un profil de sortie.
+
+    Args:
+        profile (dict): Profil de sortie (voir `_resolve_profile`).
+        dtype (str): Type de données du raster écrit.
+
+    Returns:
+        dict: Options à passer à `rasterio.open(..., 'w')`.
+    """
+    options = {"compress": profile['compress']}
+    if profile['tiled']:
+        options.update({
+            "tiled": True,
+            "blockxsize": TILE_SIZE,
+            "blockysize": TILE_SIZE,
+            "num_threads": "ALL_CPUS"  # Compression multi-thread
+        })
+    if profile['predictor']:
+        # Prédicteur horizontal pour les entiers, flottant pour les réels
+        options["predictor"] = 3 if np.issubdtype(np.dtype(dtype), np.floating) else 2
+    return options
+
+
+def _work_path(output_path, profile):
+    """
+    Retourne le fichier à écrire : la sortie elle-même, ou un fichier temporaire
+    converti en COG par `_finalize_output`.
+    """
+    return f'{output_path}.tmp.tif' if profile['cog'] else output_path
+
+
+def _block_rows(block_size, profile):
+    """
+    Arrondit une taille de bloc (lignes) au multiple supérieur de la hauteur des tuiles,
+    pour que chaque tuile de sortie soit écrite en une seule fois.
+    """
+    if not profile['tiled']:
+        return block_size
+    return -(-block_size // TILE_SIZE) * TILE_SIZE
+
+
+def _finalize_output(output_path, profile, band_names=None):
+    """
+    Termine l'écriture d'un raster : noms des bandes, aperçus internes et conversion COG.
+
+    Args:
+        output_path (str): Chemin final du raster.
+        profile (dict): Profil de sortie.
+        band_names (list, optional): Noms à attribuer aux bandes.
+    """
+    work_path = _work_path(output_path, profile)
+
+    if band_names:
+        add_band_names(work_path, band_names)
+
+    if profile['overviews'] and not profile['cog']:
+        with rasterio.open(work_path, 'r+') as dst:
+            factors = []
+            factor = 2
+            while min(dst.width, dst.height) // factor >= TILE_SIZE // 2:
+                factors.append(factor)
+                factor *= 2
+            if factors:
+                dst.build_overviews(factors, Resampling.nearest)
+                dst.update_tags(ns='rio_overview', resampling='nearest')
+
+    if profile['cog']:
+        with rasterio.open(work_path) as src:
+            predictor = 'YES' if profile['predictor'] else 'NO'
+            rio_copy(src, output_path, driver='COG', COMPRESS=profile['compress'],
+                     PREDICTOR=predictor, BLOCKSIZE=TILE_SIZE, NUM_THREADS='ALL_CPUS',
+                     OVERVIEWS='AUTO', OVERVIEW_RESAMPLING='NEAREST')
+        os.remove(work_path)
+
+
+# Cache mémoire des géométries bufferisées, par processus : {clé : GeoDataFrame}
+_BUFFERED_SHAPES = {}
+
+# Empreintes des GeoPackages déjà calculées : {(chemin, taille, mtime) : sha256}
+_FILE_HASHES = {}
+
+
+def _file_hash(path, chunk_size=1 << 20):
+    """
+    Calcule l'empreinte SHA-256 du contenu d'un fichier (mémorisée tant qu'il ne change pas).
+
+    Args:
+        path (str): Chemin du fichier.
+        chunk_size (int): Taille des morceaux lus (défaut : 1 Mo).
+
+    Returns:
+        str: Empreinte hexadécimale.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _FILE_HASHES:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                sha.update(chunk)
+        _FILE_HASHES[key] = sha.hexdigest()
+    return _FILE_HASHES[key]
+
+
+def load_buffered_shapes(gpkg_path, layer, buffer_distance, cache_dir=None):
+    """
+    Charge les géométries bufferisées et valides d'une couche, avec cache persistant.
+
+    Les géométries sont d'abord réparées par `normaliser_geometries` (toutes les parties
+    des MultiPolygon sont conservées), de sorte qu'aucune géométrie invalide n'atteint le
+    buffer ni le masquage. Le cache est indexé par l'empreinte du contenu du GeoPackage,
+    le nom de la couche et la distance de buffer. Il est conservé en mémoire et dans un fichier GeoParquet annexe,
+    réutilisé entre zones et entre exécutions tant que le GeoPackage ne change pas.
+
+    Args:
+        gpkg_path (str): Chemin du GeoPackage.
+        layer (str): Nom de la couche.
+        buffer_distance (float): Distance de buffer (négative pour rétrécir).
+        cache_dir (str, optional): Répertoire du cache (défaut : '.cache' à côté du GeoPackage).
+
+    Returns:
+        GeoDataFrame: Géométries bufferisées, non vides et valides.
+    """
+    digest = _file_hash(gpkg_path)[:16]
+    key = (digest, layer, buffer_distance)
+    if key in _BUFFERED_SHAPES:
+        return _BUFFERED_SHAPES[key]
+
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(gpkg_path)), '.cache')
+    stem = os.path.splitext(os.path.basename(gpkg_path))[0]
+    cache_path = os.path.join(cache_dir,
+                              f'{stem}_{layer}_valid_buf{buffer_distance:g}_{digest}.parquet')
+
+    if os.path.exists(cache_path):
+        shapes = gpd.read_parquet(cache_path)
+    else:
+        shapes = gpd.read_file(gpkg_path, layer=layer, columns=[])
+        # Géométries réparées, toutes les parties conservées, avant le buffer
+        shapes, _ = normaliser_geometries(shapes, politique='exploser')
+        shapes['geometry'] = shapes['geometry'].buffer(buffer_distance)
+
+        # Filtrer les géométries nulles ou invalides
+        shapes = shapes[shapes['geometry'].is_valid & ~shapes['geometry'].is_empty]
+
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f'{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        shapes.to_parquet(tmp_path)
+        os.replace(tmp_path, cache_path)
+
+    _BUFFERED_SHAPES[key] = shapes
+    return shapes
+
+
+def _iter_row_windows(window, block_size):
+    """
+    Découpe une fenêtre en bandes de lignes successives couvrant toute sa largeur.
+
+    Args:
+        window (Window): Fenêtre à parcourir.
+        block_size (int): Nombre de lignes par bloc.
+
+    Yields:
+        Window: Fenêtre de chaque bloc, dans l'ordre des lignes.
+    """
+    col_off, row_off = int(window.col_off), int(window.row_off)
+    width, height = int(window.width), int(window.height)
+    for start in range(0, height, block_size):
+        nrows = min(block_size, height - start)
+        yield Window(col_off, row_off + start, width, nrows)
+
+
+def clip_raster(raster_path, gpkg_path, output_dir, output_name, nodata_value, dtype_value,
+                block_size=None, output_profile='lzw', band_names=None):
     """
     Applique une découpe à un raster en utilisant un shapefile et gère nodata/dtype.
 
@@ -86,23 +377,41 @@ def clip_raster(raster_path, gpkg_path, output_dir, output_name, nodata_value, d
         output_name (str): Nom du fichier raster de sortie.
         nodata_value (int/float): Valeur NoData à attribuer.
         dtype_value (str): Type de données à utiliser (ex: 'int16', 'float32').
+        block_size (int, optional): Si renseigné, la découpe est faite en flux par blocs
+            de `block_size` lignes : le masque des parcelles est rasterisé bloc par bloc
+            et chaque bloc est écrit directement dans le GeoTIFF. La mémoire reste
+            bornée par la taille du bloc et le résultat est identique au mode complet.
+        output_profile (str ou dict, optional): Profil de sortie de `OUTPUT_PROFILES`
+            ('lzw' par défaut, 'tiled', 'cog', 'cog_deflate').
+        band_names (list, optional): Noms des bandes, appliqués avant la finalisation
+            (nécessaire en COG, dont la structure ne doit plus être modifiée ensuite).
 
     Returns:
         str: Chemin du raster découpe.
     """
-    # Charger le shapefile et appliquer un buffer de -10 m pour exclure les pixels en bordure
-    shapes = gpd.read_file(gpkg_path, layer='peupleraies_merged_parcelle')
-    shapes['geometry'] = shapes['geometry'].buffer(-10)
-
-    # Filtrer les géométries nulles ou invalides
-    shapes = shapes[shapes['geometry'].is_valid & ~shapes['geometry'].is_empty]
+    # Charger les parcelles avec un buffer de -10 m (exclut les pixels en bordure),
+    # depuis le cache si le GeoPackage n'a pas changé
+    shapes = load_buffered_shapes(gpkg_path, 'peupleraies_merged_parcelle', -10)
 
     # Vérifier la validation des géometries
     if shapes.empty:
         raise ValueError("Le shapefile est vide après application du buffer.")
 
+    profile = _resolve_profile(output_profile)
+
     # Ouvrir le VRT
     with rasterio.open(raster_path) as src:
+        os.makedirs(output_dir, exist_ok=True)
+        output_path = os.path.join(output_dir, f'{output_name}.tif')
+
+        if block_size:
+            _clip_raster_blocks(src, shapes.geometry, _work_path(output_path, profile),
+                                nodata_value, dtype_value, _block_rows(block_size, profile),
+                                profile)
+            _finalize_output(output_path, profile, band_names)
+            print(f"Raster découpe enregistré à : {output_path}")
+            return output_path
+
         out_image, out_transform = mask(
             src, shapes.geometry, crop=True, nodata=nodata_value
         )
@@ -115,80 +424,397 @@ def clip_raster(raster_path, gpkg_path, output_dir, output_name, nodata_value, d
             "width": out_image.shape[2],
             "transform": out_transform,
             "nodata": nodata_value,
-            "dtype": dtype_value,
-            "compress": "LZW"
+            "dtype": dtype_value
         })
+        out_meta.update(_creation_options(profile, dtype_value))
 
         # Sauvegarder le raster découpe
-        os.makedirs(output_dir, exist_ok=True)
-        output_path = os.path.join(output_dir, f'{output_name}.tif')
-        with rasterio.open(output_path, 'w', **out_meta) as dst:
+        with rasterio.open(_work_path(output_path, profile), 'w', **out_meta) as dst:
             dst.write(out_image.astype(dtype_value))
+        _finalize_output(output_path, profile, band_names)
 
         print(f"Raster découpe enregistré à : {output_path}")
         return output_path
 
 
-def clip_and_align_raster(input_raster, reference_raster, output_raster):
+def _clip_raster_blocks(src, geometries, output_path, nodata_value, dtype_value, block_size,
+                        profile):
+    """
+    Découpe un raster bloc par bloc en reproduisant exactement `rasterio.mask.mask(crop=True)`.
+
+    Args:
+        src (DatasetReader): Raster source ouvert.
+        geometries (GeoSeries): Géométries de découpe (déjà bufferisées et valides).
+        output_path (str): Chemin du GeoTIFF de sortie.
+        nodata_value (int/float): Valeur NoData à attribuer.
+        dtype_value (str): Type de données de sortie.
+        block_size (int): Nombre de lignes par bloc.
+        profile (dict): Profil de sortie.
+    """
+    # Emprise de la découpe : même fenêtre et même erreur que mask(crop=True)
+    try:
+        crop_window = geometry_window(src, geometries)
+    except WindowError:
+        raise ValueError("Input shapes do not overlap raster.")
+    out_transform = src.window_transform(crop_window)
+
+    out_meta = src.meta.copy()
+    out_meta.update({
+        "driver": "GTiff",
+        "height": int(crop_window.height),
+        "width": int(crop_window.width),
+        "transform": out_transform,
+        "nodata": nodata_value,
+        "dtype": dtype_value
+    })
+    out_meta.update(_creation_options(profile, dtype_value))
+
+    # Index spatial pour ne rasteriser que les parcelles touchant chaque bloc
+    sindex = geometries.sindex
+
+    with rasterio.open(output_path, 'w', **out_meta) as dst:
+        for window in _iter_row_windows(crop_window, block_size):
+            block_transform = src.window_transform(window)
+            block_shape = (int(window.height), int(window.width))
+            dst_window = Window(0, int(window.row_off - crop_window.row_off),
+                                block_shape[1], block_shape[0])
+
+            # Sélection des parcelles intersectant l'emprise du bloc
+            bounds = rasterio.windows.bounds(window, src.transform)
+            idx = sindex.query(box(*bounds))
+            if len(idx) == 0:
+                # Bloc hors parcelles : uniquement du NoData, pas de lecture
+                block = np.full((src.count,) + block_shape,
+                                nodata_value, dtype=src.dtypes[0])
+                dst.write(block.astype(dtype_value), window=dst_window)
+                continue
+
+            shape_mask = geometry_mask(geometries.iloc[idx], transform=block_transform,
+                                       out_shape=block_shape)
+
+            # Même séquence que mask() : lecture masquée, union des masques, remplissage
+            block = src.read(window=window, masked=True)
+            block.mask = block.mask | shape_mask
+            dst.write(block.filled(nodata_value).astype(dtype_value), window=dst_window)
+
+
+def _reference_grid(reference_raster):
+    """
+    Lit la grille (CRS, transform, dimensions) d'un raster de référence.
+
+    Args:
+        reference_raster (str): Chemin du raster de référence.
+
+    Returns:
+        dict: Clés 'crs', 'transform', 'width' et 'height'.
+    """
+    with rasterio.open(reference_raster) as ref:
+        return {
+            "crs": ref.crs,
+            "transform": ref.transform,
+            "width": ref.width,
+            "height": ref.height
+        }
+
+
+def _aligned_vrt(src, grid, nodata_value):
+    """
+    Crée un VRT reprojetant un raster source sur une grille de référence.
+
+    La tolérance quasi nulle garantit un plus proche voisin exact, indépendant du
+    découpage en blocs de la lecture.
+
+    Args:
+        src (DatasetReader): Raster source ouvert.
+        grid (dict): Grille de référence (voir `_reference_grid`).
+        nodata_value (int/float): NoData de sortie, aussi utilisé hors emprise source.
+
+    Returns:
+        WarpedVRT: VRT à lire fenêtre par fenêtre.
+    """
+    return WarpedVRT(
+        src,
+        nodata=nodata_value,  # Hors emprise source : NoData (et non 0)
+        dtype="float32",
+        resampling=Resampling.nearest,  # Utiliser 'nearest' pour éviter la moyenne
+        tolerance=1e-6,
+        **grid
+    )
+
+
+def clip_and_align_raster(input_raster, reference_raster, output_raster, block_size=1024,
+                          output_profile='lzw'):
     """
     Aligne et clip un raster lidar sur la base d'un raster de référence.
 
+    L'alignement passe par un VRT reprojeté sur la grille de référence, lu fenêtre par
+    fenêtre : GDAL ne lit que la fenêtre source couvrant chaque bloc de sortie, la mémoire
+    reste donc bornée par `block_size` quelle que soit la taille du raster lidar.
+
     Args:
         input_raster (str): Chemin du raster lidar à aligner.
         reference_raster (str): Chemin du raster de référence.
         output_raster (str): Chemin de sortie pour le raster aligné et découpe.
+        block_size (int, optional): Nombre de lignes de sortie par bloc (défaut : 1024).
+        output_profile (str ou dict, optional): Profil de sortie (voir `clip_raster`).
     """
-    with rasterio.open(reference_raster) as ref:
-        ref_transform = ref.transform
-        ref_crs = ref.crs
-        ref_width = ref.width
-        ref_height = ref.height
-        ref_bounds = ref.bounds
+    grid = _reference_grid(reference_raster)
+    profile_sortie = _resolve_profile(output_profile)
+    block_size = _block_rows(block_size, profile_sortie)
 
     with rasterio.open(input_raster) as src:
         # Assurer une valeur NoData correcte
         nodata_value = src.nodata if src.nodata is not None else -999
 
-        # Créer un tableau vide aligné à la résolution du raster de référence
-        aligned_data = np.full((ref_height, ref_width),
-                               nodata_value, dtype=np.float32)
-
-        # Reprojection avec filtre sur les limites valides
-        reproject(
-            source=src.read(1),
-            destination=aligned_data,
-            src_transform=src.transform,
-            src_crs=src.crs,
-            dst_transform=ref_transform,
-            dst_crs=ref_crs,
-            dst_width=ref_width,
-            dst_height=ref_height,
-            resampling=Resampling.nearest,  # Utiliser 'nearest' pour éviter la moyenne
-        )
+        # Mettre à jour le profil pour l'écriture
+        profile = {
+            "driver": "GTiff",
+            "dtype": "float32",
+            "nodata": nodata_value,
+            "count": 1,
+            **grid,
+            **_creation_options(profile_sortie, "float32")
+        }
+
+        os.makedirs(os.path.dirname(output_raster), exist_ok=True)
+        with _aligned_vrt(src, grid, nodata_value) as vrt, \
+                rasterio.open(_work_path(output_raster, profile_sortie), "w", **profile) as dst:
+            for window in _iter_row_windows(Window(0, 0, grid["width"], grid["height"]),
+                                            block_size):
+                aligned_data = vrt.read(1, window=window)
+
+                # Corriger les pixels invalides (zones hors raster source), sur place
+                if src.nodata is not None:
+                    aligned_data[aligned_data == src.nodata] = nodata_value
 
-        # Corriger les pixels invalides (zones hors raster source)
-        aligned_data = np.where(
-            aligned_data == src.nodata, nodata_value, aligned_data)
+                dst.write(aligned_data, 1, window=window)
+
+    _finalize_output(output_raster, profile_sortie)
+    print(f"Raster aligné sauvegardé à : {output_raster}")
+
+
+def align_lidar_stack(input_rasters, reference_raster, output_raster, nodata_value=-999,
+                      block_size=1024, output_profile='lzw'):
+    """
+    Aligne plusieurs métriques lidar sur un raster de référence en une seule passe.
 
-    # Mettre à jour le profil pour l'écriture
+    La grille de référence est lue une seule fois, chaque métrique est reprojetée bloc
+    par bloc et le tout est écrit dans un seul raster multibande dont les bandes portent
+    le nom des métriques (lisible d'un coup par `extract_lidar_values`).
+
+    Args:
+        input_rasters (dict): Dictionnaire {nom_métrique : chemin_raster}.
+        reference_raster (str): Chemin du raster de référence.
+        output_raster (str): Chemin de sortie de la pile alignée.
+        nodata_value (int/float, optional): NoData commun de la pile (défaut : -999).
+        block_size (int, optional): Nombre de lignes de sortie par bloc (défaut : 1024).
+        output_profile (str ou dict, optional): Profil de sortie (voir `clip_raster`).
+
+    Returns:
+        str: Chemin de la pile alignée.
+    """
+    if not input_rasters:
+        raise ValueError("Aucune métrique lidar à aligner.")
+
+    grid = _reference_grid(reference_raster)
+    profile_sortie = _resolve_profile(output_profile)
+    block_size = _block_rows(block_size, profile_sortie)
     profile = {
         "driver": "GTiff",
         "dtype": "float32",
         "nodata": nodata_value,
-        "width": ref_width,
-        "height": ref_height,
-        "count": 1,
-        "crs": ref_crs,
-        "transform": ref_transform,
-        "compress": "LZW"
+        "count": len(input_rasters),
+        **grid,
+        **_creation_options(profile_sortie, "float32")
     }
 
-    # Sauvegarder le raster aligné
     os.makedirs(os.path.dirname(output_raster), exist_ok=True)
-    with rasterio.open(output_raster, "w", **profile) as dst:
-        dst.write(aligned_data, 1)
+    with ExitStack() as stack:
+        sources = [stack.enter_context(rasterio.open(path)) for path in input_rasters.values()]
+        vrts = [stack.enter_context(_aligned_vrt(src, grid, nodata_value)) for src in sources]
+        dst = stack.enter_context(
+            rasterio.open(_work_path(output_raster, profile_sortie), "w", **profile))
 
-    print(f"Raster aligné sauvegardé à : {output_raster}")
+        for window in _iter_row_windows(Window(0, 0, grid["width"], grid["height"]),
+                                        block_size):
+            for band, (src, vrt) in enumerate(zip(sources, vrts), start=1):
+                aligned_data = vrt.read(1, window=window)
+
+                # Ramener le NoData propre à chaque métrique au NoData commun
+                if src.nodata is not None:
+                    aligned_data[aligned_data == src.nodata] = nodata_value
+
+                dst.write(aligned_data, band, window=window)
+
+    _finalize_output(output_raster, profile_sortie, list(input_rasters))
+    print(f"Pile lidar alignée sauvegardée à : {output_raster}")
+    return output_raster
+
+
+def _merge_moments(stats, values, min_b, max_b):
+    """
+    Fusionne les statistiques d'un bloc (effectif, min, max, moyenne, M2) dans l'état courant.
+
+    Args:
+        stats (dict): État courant, modifié sur place.
+        values (np.ndarray): Valeurs valides du bloc (1D, non vide).
+        min_b, max_b: Minimum et maximum du bloc.
+    """
+    n_b = values.size
+    mean_b = float(values.mean(dtype=np.float64))
+    m2_b = float(np.square(values - mean_b, dtype=np.float64).sum())
+
+    n_a = stats['valid_count']
+    if n_a == 0:
+        stats.update(valid_count=n_b, mean=mean_b, m2=m2_b, min=min_b, max=max_b)
+        return
+
+    # Combinaison de Chan et al. pour la moyenne et la somme des carrés des écarts
+    n = n_a + n_b
+    delta = mean_b - stats['mean']
+    stats['mean'] += delta * n_b / n
+    stats['m2'] += m2_b + delta * delta * n_a * n_b / n
+    stats['valid_count'] = n
+    stats['min'] = min(stats['min'], min_b)
+    stats['max'] = max(stats['max'], max_b)
+
+
+def _update_histogram(hist, values, vmin, vmax):
+    """
+    Ajoute un bloc à un histogramme approché à nombre de classes fixe.
+
+    Les bornes sont fixées sur le premier bloc puis élargies au besoin en doublant la
+    largeur des classes (fusion deux à deux), ce qui permet un seul passage sans connaître
+    l'étendue des valeurs à l'avance.
+
+    Args:
+        hist (dict): État de l'histogramme ('bins', 'lo', 'width', 'counts'), modifié sur place.
+        values (np.ndarray): Valeurs valides du bloc (1D, non vide).
+        vmin, vmax: Minimum et maximum du bloc.
+    """
+    nbins = hist['bins']
+    vmin, vmax = float(vmin), float(vmax)
+    if hist['counts'] is None:
+        hist['lo'] = vmin
+        hist['width'] = (vmax - vmin) / nbins if vmax > vmin else 1.0
+        hist['counts'] = np.zeros(nbins, dtype=np.int64)
+
+    # Élargir l'étendue tant que le bloc n'y tient pas
+    while vmin < hist['lo'] or vmax > hist['lo'] + nbins * hist['width']:
+        merged = hist['counts'].reshape(-1, 2).sum(axis=1)
+        pad = np.zeros(nbins - merged.size, dtype=np.int64)
+        if vmin < hist['lo']:
+            hist['lo'] -= nbins * hist['width']
+            hist['counts'] = np.concatenate([pad, merged])
+        else:
+            hist['counts'] = np.concatenate([merged, pad])
+        hist['width'] *= 2
+
+    idx = ((values - hist['lo']) / hist['width']).astype(np.int64)
+    np.clip(idx, 0, nbins - 1, out=idx)
+    hist['counts'] += np.bincount(idx, minlength=nbins)
+
+
+def _band_stats(raster_path, bidx, block_size, bins):
+    """
+    Calcule les statistiques d'une bande en un seul passage sur ses blocs.
+
+    Args:
+        raster_path (str): Chemin du raster.
+        bidx (int): Indice de la bande (à partir de 1).
+        block_size (int): Nombre de lignes par bloc.
+        bins (int): Nombre de classes de l'histogramme (pair).
+
+    Returns:
+        dict: Statistiques de la bande, sérialisables en JSON.
+    """
+    stats = {'valid_count': 0, 'mean': 0.0, 'm2': 0.0, 'min': None, 'max': None}
+    hist = {'bins': bins, 'lo': None, 'width': None, 'counts': None}
+    nodata_count = 0
+
+    # Chaque thread ouvre son propre jeu de données (non partageable entre threads)
+    with rasterio.open(raster_path) as src:
+        nodata = src.nodata
+        name = src.descriptions[bidx - 1]
+        for window in _iter_row_windows(Window(0, 0, src.width, src.height), block_size):
+            bloc = src.read(bidx, window=window)
+
+            # Exclure les valeurs NoData (et NaN, ±inf) pour les statistiques : une valeur
+            # infinie élargirait l'histogramme jusqu'au dépassement
+            valide = np.ones(bloc.shape, dtype=bool) if nodata is None else bloc != nodata
+            if np.issubdtype(bloc.dtype, np.floating):
+                valide &= np.isfinite(bloc)
+            values = bloc[valide]
+            nodata_count += bloc.size - values.size
+
+            if values.size:
+                vmin, vmax = values.min(), values.max()
+                _merge_moments(stats, values, vmin, vmax)
+                _update_histogram(hist, values, vmin, vmax)
+
+    n = stats['valid_count']
+    result = {
+        'band': bidx,
+        'name': name,
+        'nodata_count': int(nodata_count),
+        'valid_count': int(n),
+        'min': None, 'max': None, 'mean': None, 'std': None, 'histogram': None
+    }
+    if n:
+        result.update({
+            'min': stats['min'].item(),
+            'max': stats['max'].item(),
+            'mean': stats['mean'],
+            'std': float(np.sqrt(stats['m2'] / n)),
+            'histogram': {
+                'edges': (hist['lo'] + hist['width'] * np.arange(bins + 1)).tolist(),
+                'counts': hist['counts'].tolist()
+            }
+        })
+    return result
+
+
+def raster_stats(raster_path, block_size=512, bins=64, max_workers=None, json_path=None):
+    """
+    Calcule les statistiques d'un raster en un seul passage par blocs, bandes en parallèle.
+
+    Pour chaque bande : nombre de pixels valides et NoData (NaN et ±inf compris), min, max,
+    moyenne, écart-type et histogramme approché. Le résultat est un dictionnaire
+    sérialisable en JSON, destiné au contrôle qualité automatisé de nombreux rasters.
+
+    Args:
+        raster_path (str): Chemin du fichier raster à analyser.
+        block_size (int, optional): Nombre de lignes lues par bloc (défaut : 512).
+        bins (int, optional): Nombre de classes de l'histogramme, pair (défaut : 64).
+        max_workers (int, optional): Nombre de threads (défaut : une par bande).
+        json_path (str, optional): Si renseigné, écrit aussi le résultat en JSON.
+
+    Returns:
+        dict: Propriétés du raster ('path', 'count', 'nodata', 'res', 'crs') et liste
+        'bands' des statistiques par bande.
+    """
+    if bins % 2:
+        raise ValueError("Le nombre de classes de l'histogramme doit être pair.")
+
+    with rasterio.open(raster_path) as src:
+        result = {
+            'path': raster_path,
+            'count': src.count,
+            'nodata': src.nodata,
+            'res': list(src.res),
+            'crs': src.crs.to_string() if src.crs else None
+        }
+        bidxs = list(src.indexes)
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(bidxs)) as pool:
+        result['bands'] = list(pool.map(
+            lambda bidx: _band_stats(raster_path, bidx, block_size, bins), bidxs))
+
+    if json_path:
+        os.makedirs(os.path.dirname(json_path) or '.', exist_ok=True)
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+    return result
 
 
 def verifier_raster(raster_path):
@@ -202,37 +828,429 @@ def verifier_raster(raster_path):
         - Nombre de bandes, valeur NoData, résolution, et projection.
         - Nombre de pixels valides et NoData pour chaque bande.
         - Statistiques (min, max, moyenne) pour les pixels valides.
+
+    Returns:
+        dict: Résultat de `raster_stats`.
     """
+    stats = raster_stats(raster_path)
 
-    with rasterio.open(raster_path) as src:
-        print(f"=== Vérification du Raster: {raster_path} ===")
-        print(f"Nombre de bandes: {src.count}")
-        print(f"Valeur NoData: {src.nodata}")
-        print(f"Résolution: {src.res}")
-        print(f"Projection (CRS): {src.crs}")
-
-        # Parcourir chaque bande
-        for i in range(1, src.count + 1):
-            bande = src.read(i)
-            nodata_valeur = src.nodata
-
-            # Exclure les valeurs NoData pour les statistiques
-            bande_valide = bande[bande != nodata_valeur]
-
-            # Compter les pixels NoData et valides
-            nodata_count = np.sum(bande == nodata_valeur)
-            valide_count = np.sum(bande != nodata_valeur)
-
-            # Afficher les résultats
-            print(f"--- Bande {i} ---")
-            print(f"  Pixels NoData (0): {nodata_count}")
-            print(f"  Pixels valides: {valide_count}")
-
-            if bande_valide.size > 0:
-                print(f"  Min: {np.min(bande_valide)}")
-                print(f"  Max: {np.max(bande_valide)}")
-                print(f"  Moyenne: {np.mean(bande_valide)}")
-            else:
-                print(f"  Bande {i} contient uniquement des valeurs NoData.")
+    print(f"=== Vérification du Raster: {raster_path} ===")
+    print(f"Nombre de bandes: {stats['count']}")
+    print(f"Valeur NoData: {stats['nodata']}")
+    print(f"Résolution: {tuple(stats['res'])}")
+    print(f"Projection (CRS): {stats['crs']}")
+
+    # Parcourir chaque bande
+    for bande in stats['bands']:
+        i = bande['band']
+        print(f"--- Bande {i} ---")
+        print(f"  Pixels NoData (0): {bande['nodata_count']}")
+        print(f"  Pixels valides: {bande['valid_count']}")
+
+        if bande['valid_count'] > 0:
+            print(f"  Min: {bande['min']}")
+            print(f"  Max: {bande['max']}")
+            print(f"  Moyenne: {bande['mean']}")
+        else:
+            print(f"  Bande {i} contient uniquement des valeurs NoData.")
+
+    print("="*40)
+    return stats
+
+
+# * ======================================= * #
+# * ======================================= * #
+#   Exécution parallèle de la découpe       * #
+# * ======================================= * #
+# * ======================================= * #
+
+def _run_job(job, func, kwargs, gdal_cache_mb):
+    """
+    Exécute une tâche de découpe dans un worker et retourne son enregistrement de résultat.
+
+    Args:
+        job (dict): Description de la tâche (type, zone, métrique).
+        func (callable): Fonction à exécuter, doit retourner le chemin de sortie.
+        kwargs (dict): Arguments passés à `func`.
+        gdal_cache_mb (int): Budget du cache GDAL (Mo) pour ce worker.
+
+    Returns:
+        dict: Tâche complétée par 'output', 'duration' (s) et 'error' (None si succès).
+    """
+    record = dict(job, output=None, duration=None, error=None)
+    debut = time.perf_counter()
+    try:
+        with rasterio.Env(GDAL_CACHEMAX=gdal_cache_mb):
+            record['output'] = func(**kwargs)
+    except Exception:
+        record['error'] = traceback.format_exc()
+    record['duration'] = time.perf_counter() - debut
+    return record
+
+
+def _confidence_job(base_dir, zone, annees, gpkg_path, output_confidence_temp,
+                    output_confidence_final, block_size=None, output_profile='lzw'):
+    """
+    Crée le VRT de confiance d'une zone, le découpe et nomme les bandes par année.
+
+    Returns:
+        str: Chemin du raster de confiance découpé.
+    """
+    vrt_path = create_vrt(base_dir, zone, annees, 'confidence', output_confidence_temp)
+    if vrt_path is None:
+        raise FileNotFoundError(f"Aucun raster de confiance pour la zone {zone}")
+
+    output_raster = clip_raster(
+        raster_path=vrt_path,
+        gpkg_path=gpkg_path,
+        output_dir=output_confidence_final,
+        output_name=f"confidence_clipped_{zone}",
+        nodata_value=-999,
+        dtype_value='int16',
+        block_size=block_size,
+        output_profile=output_profile,
+        band_names=[str(annee) for annee in annees]
+    )
+    return output_raster
+
+
+def _lidar_job(input_raster, reference_raster, zone, metric, gpkg_path,
+               output_lidar_temp, output_lidar_final, block_size=None, output_profile='lzw'):
+    """
+    Aligne une métrique LiDAR sur le raster de confiance d'une zone puis la découpe.
+
+    Returns:
+        str: Chemin du raster LiDAR découpé.
+    """
+    if not os.path.exists(input_raster):
+        raise FileNotFoundError(f"Fichier LiDAR manquant : {input_raster}")
+
+    output_aligned = os.path.join(output_lidar_temp, f"{metric}_clipped_{zone}.tif")
+    clip_and_align_raster(input_raster, reference_raster, output_aligned,
+                          output_profile=output_profile)
+    return clip_raster(
+        raster_path=output_aligned,
+        gpkg_path=gpkg_path,
+        output_dir=output_lidar_final,
+        output_name=f"{metric}_clipped_{zone}",
+        nodata_value=-999,
+        dtype_value='float32',
+        block_size=block_size,
+        output_profile=output_profile
+    )
+
+
+def _lidar_stack_job(input_rasters, reference_raster, zone, gpkg_path,
+                     output_lidar_temp, output_lidar_final, block_size=None,
+                     output_profile='lzw'):
+    """
+    Aligne toutes les métriques LiDAR d'une zone en une pile multibande puis la découpe.
+
+    Returns:
+        str: Chemin de la pile LiDAR découpée.
+    """
+    manquants = [path for path in input_rasters.values() if not os.path.exists(path)]
+    if manquants:
+        raise FileNotFoundError(f"Fichiers LiDAR manquants : {manquants}")
+
+    output_aligned = os.path.join(output_lidar_temp, f"lidar_stack_clipped_{zone}.tif")
+    align_lidar_stack(input_rasters, reference_raster, output_aligned,
+                      output_profile=output_profile)
+    return clip_raster(
+        raster_path=output_aligned,
+        gpkg_path=gpkg_path,
+        output_dir=output_lidar_final,
+        output_name=f"lidar_stack_clipped_{zone}",
+        nodata_value=-999,
+        dtype_value='float32',
+        block_size=block_size,
+        output_profile=output_profile,
+        band_names=list(input_rasters)
+    )
+
+
+# * ======================================= * #
+# * ======================================= * #
+#   Manifeste de reconstruction incrémentale * #
+# * ======================================= * #
+# * ======================================= * #
+
+def load_manifest(manifest_path):
+    """
+    Charge le manifeste de reconstruction (vide s'il n'existe pas encore).
+
+    Args:
+        manifest_path (str): Chemin du fichier JSON.
+
+    Returns:
+        dict: Manifeste, avec une entrée par sortie sous la clé 'outputs'.
+    """
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding='utf-8') as f:
+            return json.load(f)
+    return {'outputs': {}}
+
+
+def save_manifest(manifest, manifest_path):
+    """
+    Écrit le manifeste de reconstruction de façon atomique.
+
+    Args:
+        manifest (dict): Manifeste à écrire.
+        manifest_path (str): Chemin du fichier JSON.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+    tmp_path = f'{manifest_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def _file_signature(path, previous=None):
+    """
+    Calcule la signature (taille, date de modification, SHA-256) d'un fichier d'entrée.
+
+    Le contenu n'est relu que si la taille ou la date a changé depuis la signature
+    précédente ; un simple `touch` ne provoque donc qu'un recalcul de l'empreinte.
+
+    Args:
+        path (str): Chemin du fichier.
+        previous (dict, optional): Signature enregistrée lors de la dernière exécution.
+
+    Returns:
+        dict ou None : Signature, ou None si le fichier n'existe pas.
+    """
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    if previous and previous['size'] == stat.st_size and previous['mtime_ns'] == stat.st_mtime_ns:
+        return previous
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': _file_hash(path)}
+
+
+def _output_signature(path):
+    """
+    Retourne la taille et la date de modification d'une sortie (None si absente).
+    """
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _input_signatures(manifest, output, inputs):
+    """
+    Calcule les signatures des entrées d'une sortie en réutilisant celles du manifeste.
+
+    Args:
+        manifest (dict): Manifeste courant.
+        output (str): Chemin de la sortie.
+        inputs (list): Chemins des fichiers d'entrée.
+
+    Returns:
+        dict: {chemin_entrée : signature}.
+    """
+    entry = manifest['outputs'].get(os.path.normpath(output), {})
+    previous = entry.get('inputs', {})
+    return {os.path.normpath(path): _file_signature(path, previous.get(os.path.normpath(path)))
+            for path in inputs}
+
+
+def _is_up_to_date(manifest, output, signatures, params):
+    """
+    Indique si une sortie est à jour : présente et inchangée, mêmes entrées, mêmes paramètres.
+
+    Args:
+        manifest (dict): Manifeste courant.
+        output (str): Chemin de la sortie.
+        signatures (dict): Signatures actuelles des entrées.
+        params (dict): Paramètres actuels de la tâche.
+
+    Returns:
+        bool: True si la tâche peut être sautée.
+    """
+    entry = manifest['outputs'].get(os.path.normpath(output))
+    if entry is None or None in signatures.values():
+        return False
+    current = {path: sig['sha256'] for path, sig in signatures.items()}
+    recorded = {path: sig['sha256'] for path, sig in entry['inputs'].items()}
+    return (current == recorded
+            and entry['params'] == params
+            and entry['output'] == _output_signature(output))
+
+
+def _grid_params(raster_path):
+    """
+    Décrit la grille d'un raster de référence sous forme sérialisable en JSON.
+    """
+    grid = _reference_grid(raster_path)
+    return {
+        'crs': grid['crs'].to_wkt() if grid['crs'] else None,
+        'transform': list(grid['transform'])[:6],
+        'width': grid['width'],
+        'height': grid['height']
+    }
+
+
+def clip_tiles_parallel(base_dir, zones, annees, lidar_metrics, gpkg_path,
+                        output_confidence_temp, output_confidence_final,
+                        output_lidar_temp, output_lidar_final,
+                        lidar_exclude=(), max_workers=None, gdal_cache_mb=256,
+                        block_size=None, lidar_stack=False, output_profile='lzw',
+                        manifest_path=None):
+    """
+    Lance toute la découpe (confiance + LiDAR) des zones sur un pool de processus.
+
+    Chaque zone produit une tâche de confiance (VRT, découpe, noms de bandes). Dès
+    qu'elle est terminée, une tâche par métrique LiDAR (alignement puis découpe) est
+    soumise pour cette zone, les tâches des autres zones continuant en parallèle.
+
+    Args:
+        base_dir (str): Répertoire des rasters bruts (années et métriques LiDAR).
+        zones (list): Liste des tuiles à traiter.
+        annees (list): Liste des années des rasters de confiance.
+        lidar_metrics (list): Noms des métriques LiDAR (ex: 'grid_CC').
+        gpkg_path (str): Chemin du GeoPackage utilisé pour la découpe.
+        output_confidence_temp (str): Répertoire des VRT de confiance.
+        output_confidence_final (str): Répertoire des rasters de confiance découpés.
+        output_lidar_temp (str): Répertoire des rasters LiDAR alignés.
+        output_lidar_final (str): Répertoire des rasters LiDAR découpés.
+        lidar_exclude (iterable, optional): Zones sans métriques LiDAR (ex: 'T31UEP').
+        max_workers (int, optional): Nombre de processus (défaut : nombre de cœurs).
+        gdal_cache_mb (int, optional): Cache GDAL alloué à chaque worker en Mo (défaut : 256).
+        block_size (int, optional): Taille de bloc transmise à `clip_raster`.
+        lidar_stack (bool, optional): Si True, une seule tâche LiDAR par zone aligne toutes
+            les métriques en une pile multibande (`align_lidar_stack`) au lieu d'une tâche
+            par métrique ; son enregistrement a 'metric' = 'stack'.
+        output_profile (str ou dict, optional): Profil de sortie des GeoTIFF (voir
+            `clip_raster`), appliqué à toutes les tâches.
+        manifest_path (str, optional): Manifeste JSON de reconstruction incrémentale. Les
+            tâches dont la sortie est à jour (mêmes entrées d'après taille/date/SHA-256,
+            mêmes paramètres dont la grille de référence, sortie inchangée) sont sautées.
+
+    Returns:
+        list: Un dictionnaire par tâche ('job', 'zone', 'metric', 'output', 'duration',
+        'error', 'skipped'), trié par zone puis par métrique.
+    """
+    os.makedirs(output_lidar_temp, exist_ok=True)
+    os.makedirs(output_lidar_final, exist_ok=True)
+
+    manifest = load_manifest(manifest_path) if manifest_path else None
+    params_clip = {'nodata': -999, 'layer': 'peupleraies_merged_parcelle', 'buffer': -10,
+                   'make_valid': True, 'output_profile': _resolve_profile(output_profile)}
+
+    records = []
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        pending = {}
+
+        def submit(job, func, kwargs, output, inputs, params):
+            # Sauter la tâche si sa sortie est à jour d'après le manifeste
+            signatures = None
+            if manifest is not None:
+                signatures = _input_signatures(manifest, output, inputs)
+                if _is_up_to_date(manifest, output, signatures, params):
+                    # Mémoriser les dates à jour pour ne pas réempreinter un fichier touché
+                    manifest['outputs'][os.path.normpath(output)]['inputs'] = signatures
+                    complete(dict(job, output=output, duration=0.0, error=None, skipped=True))
+                    return
+            future = pool.submit(_run_job, job, func, kwargs, gdal_cache_mb)
+            pending[future] = (output, signatures, params)
+
+        def complete(record, manifest_entry=None):
+            record.setdefault('skipped', False)
+            records.append(record)
+
+            # Enregistrer la sortie reconstruite dans le manifeste
+            if manifest_entry is not None and record['error'] is None:
+                output, signatures, params = manifest_entry
+                manifest['outputs'][os.path.normpath(output)] = {
+                    'inputs': signatures,
+                    'params': params,
+                    'output': _output_signature(output)
+                }
+                save_manifest(manifest, manifest_path)
+
+            # Soumettre les métriques LiDAR dès que la référence de la zone existe
+            zone = record['zone']
+            if record['job'] != 'confidence' or zone in lidar_exclude:
+                return
+
+            metrics = ['stack'] if lidar_stack else lidar_metrics
+            if record['error'] is not None:
+                for metric in metrics:
+                    records.append({'job': 'lidar', 'zone': zone, 'metric': metric,
+                                    'output': None, 'duration': 0.0, 'skipped': False,
+                                    'error': "Raster de référence non créé."})
+                return
+
+            params = dict(params_clip, dtype='float32',
+                          reference_grid=_grid_params(record['output']))
+            if lidar_stack:
+                input_rasters = {metric: os.path.join(base_dir, f"{metric}.tif")
+                                 for metric in lidar_metrics}
+                kwargs = {
+                    'input_rasters': input_rasters,
+                    'reference_raster': record['output'],
+                    'zone': zone, 'gpkg_path': gpkg_path,
+                    'output_lidar_temp': output_lidar_temp,
+                    'output_lidar_final': output_lidar_final,
+                    'block_size': block_size,
+                    'output_profile': output_profile
+                }
+                output = os.path.join(output_lidar_final, f"lidar_stack_clipped_{zone}.tif")
+                submit({'job': 'lidar', 'zone': zone, 'metric': 'stack'}, _lidar_stack_job,
+                       kwargs, output, list(input_rasters.values()) + [gpkg_path],
+                       dict(params, metrics=list(lidar_metrics)))
+                return
+
+            for metric in lidar_metrics:
+                input_raster = os.path.join(base_dir, f"{metric}.tif")
+                kwargs = {
+                    'input_raster': input_raster,
+                    'reference_raster': record['output'],
+                    'zone': zone, 'metric': metric, 'gpkg_path': gpkg_path,
+                    'output_lidar_temp': output_lidar_temp,
+                    'output_lidar_final': output_lidar_final,
+                    'block_size': block_size,
+                    'output_profile': output_profile
+                }
+                output = os.path.join(output_lidar_final, f"{metric}_clipped_{zone}.tif")
+                submit({'job': 'lidar', 'zone': zone, 'metric': metric}, _lidar_job,
+                       kwargs, output, [input_raster, gpkg_path], params)
+
+        for zone in zones:
+            kwargs = {
+                'base_dir': base_dir, 'zone': zone, 'annees': annees,
+                'gpkg_path': gpkg_path,
+                'output_confidence_temp': output_confidence_temp,
+                'output_confidence_final': output_confidence_final,
+                'block_size': block_size,
+                'output_profile': output_profile
+            }
+            inputs = [os.path.join(base_dir, str(annee), f'confidence_{zone}_{annee}.tif')
+                      for annee in annees]
+            inputs = [path for path in inputs if os.path.exists(path)]
+            output = os.path.join(output_confidence_final, f"confidence_clipped_{zone}.tif")
+            submit({'job': 'confidence', 'zone': zone, 'metric': None}, _confidence_job,
+                   kwargs, output, inputs + [gpkg_path],
+                   dict(params_clip, dtype='int16', annees=list(annees)))
+
+        while pending:
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            for future in done:
+                complete(future.result(), pending.pop(future))
+
+    if manifest is not None:
+        save_manifest(manifest, manifest_path)
+
+    # Ordre déterministe : zone, puis confiance avant les métriques
+    ordre_metric = {metric: i for i, metric in enumerate(lidar_metrics, start=1)}
+    records.sort(key=lambda r: (zones.index(r['zone']), ordre_metric.get(r['metric'], 0)))
 
-        print("="*40)
+    for record in records:
+        statut = 'OK' if record['error'] is None else 'ERREUR'
+        if record['skipped']:
+            statut = 'À JOUR'
+        print(f"{record['zone']} {record['metric'] or 'confidence'} : {statut} "
+              f"({record['duration']:.1f} s)")
+    return records
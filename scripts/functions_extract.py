@@ -2,11 +2,24 @@
 from geopandas import sjoin
 import os
 import re
+import shutil
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
 import pandas as pd
 import geopandas as gpd
 import numpy as np
+import pyogrio
 import rasterio
+from rasterio.crs import CRS
+from rasterio.features import rasterize
+from rasterio.enums import MergeAlg
 from rasterio.transform import xy
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window
+import shapely
+from functions_stockage import append_table, apply_schema
 
 # * ======================================= * #
 # * ======================================= * #
@@ -15,8 +28,61 @@ from rasterio.transform import xy
 # * ======================================= * #
 # * ======================================= * #
 
+# Décalage de la ligne dans la clé entière d'un pixel : pixel_id = ligne << 32 | colonne
+PIXEL_ID_SHIFT = 32
 
-def extract_confidence_values(confidence_raster_path, annees, nodata=0):
+
+def pixel_id(rows, cols):
+    """
+    Calcule la clé entière des pixels d'une tuile à partir de leurs indices de grille.
+
+    Avec la tuile, `pixel_id` identifie exactement un pixel dans tous les tableaux : les
+    jointures et exclusions se font sur des entiers plutôt que sur des coordonnées arrondies.
+
+    Args :
+        rows (array-like) : Lignes des pixels dans le raster de confiance découpé.
+        cols (array-like) : Colonnes des pixels.
+
+    Returns :
+        np.ndarray : Clés int64.
+    """
+    return (np.asarray(rows, dtype=np.int64) << PIXEL_ID_SHIFT) | np.asarray(cols, dtype=np.int64)
+
+
+def pixel_rowcol(pixel_ids):
+    """
+    Retrouve les indices de grille (ligne, colonne) à partir des clés `pixel_id`.
+
+    Args :
+        pixel_ids (array-like) : Clés int64.
+
+    Returns :
+        tuple : (lignes, colonnes) en np.ndarray int64.
+    """
+    pixel_ids = np.asarray(pixel_ids, dtype=np.int64)
+    return pixel_ids >> PIXEL_ID_SHIFT, pixel_ids & ((1 << PIXEL_ID_SHIFT) - 1)
+
+
+def _add_grid_index(df, rows, cols):
+    """
+    Ajoute au tableau les indices de grille `row`, `col` et la clé `pixel_id`.
+
+    Args :
+        df (pd.DataFrame) : Tableau de pixels.
+        rows (np.ndarray) : Lignes des pixels.
+        cols (np.ndarray) : Colonnes des pixels.
+
+    Returns :
+        pd.DataFrame : Tableau modifié sur place.
+    """
+    df['row'] = rows.astype(np.int32)
+    df['col'] = cols.astype(np.int32)
+    df['pixel_id'] = pixel_id(rows, cols)
+    return df
+
+
+def extract_confidence_values(confidence_raster_path, annees, nodata=0, grid_index=False,
+                              layout='long'):
     """
     Extrait les valeurs des pixels valides d'un raster multibande, chaque bande correspondant à une année.
 
@@ -24,15 +90,32 @@ def extract_confidence_values(confidence_raster_path, annees, nodata=0):
         confidence_raster_path (str) : Chemin vers le raster multibande.
         annees (list) : Liste des années correspondant aux bandes.
         nodata (int) : Valeur des pixels sans données (défaut : 0).
+        grid_index (bool) : Ajoute les indices entiers `row` et `col` du pixel dans la
+            grille du raster, utilisés par `join_lidar_values`, et la clé `pixel_id`
+            (défaut : False).
+        layout (str) : Forme du tableau (défaut : 'long') :
+            - 'long' : une ligne par pixel et par année (format historique) ;
+            - 'compact' : mêmes lignes, dans le même ordre, mais date en int16 et tuile
+              catégorielle, avec une seule lecture du raster et un seul calcul des coordonnées ;
+            - 'wide' : une ligne par pixel valide au moins une année et une colonne par
+              année (valeur manquante les années sans donnée).
 
     Returns :
-        pd.DataFrame ou None : Tableau contenant x, y, valeur, date et tuile.
+        pd.DataFrame ou None : Tableau contenant x, y, valeur, date et tuile
+            (et row, col, pixel_id si `grid_index`), ou x, y, tuile et une colonne par année
+            en 'wide'.
     """
+    if layout not in ('long', 'compact', 'wide'):
+        raise ValueError(f"Format inconnu : {layout} (attendu : 'long', 'compact' ou 'wide')")
+
     # Vérifie si le fichier raster existe
     if not os.path.exists(confidence_raster_path):
         print(f"Raster inexistant : {confidence_raster_path}")
         return None
 
+    if layout != 'long':
+        return _extract_confidence_once(confidence_raster_path, annees, nodata, grid_index, layout)
+
     # Ouvre le raster
     with rasterio.open(confidence_raster_path) as src:
         df_list = []  # Liste pour stocker les DataFrames de chaque bande
@@ -62,6 +145,8 @@ def extract_confidence_values(confidence_raster_path, annees, nodata=0):
                 'date': annee,               # Année associée à la bande
                 'tuile': zone                # Nom de la tuile
             })
+            if grid_index:
+                _add_grid_index(df_band, rows, cols)
 
             df_list.append(df_band)
 
@@ -73,90 +158,1027 @@ def extract_confidence_values(confidence_raster_path, annees, nodata=0):
             return None  # Retourne None si aucune donnée valide n'a été trouvée
 
 
-def extract_lidar_values(lidar_raster_paths, nodata=-999):
+def _extract_confidence_once(confidence_raster_path, annees, nodata, grid_index, layout):
+    """
+    Extrait les valeurs de confiance en une lecture, avec des coordonnées calculées une fois.
+
+    Args :
+        confidence_raster_path (str) : Chemin vers le raster multibande.
+        annees (list) : Liste des années correspondant aux bandes.
+        nodata (int) : Valeur des pixels sans données.
+        grid_index (bool) : Ajoute les indices `row`, `col` et la clé `pixel_id` du pixel.
+        layout (str) : 'compact' ou 'wide' (voir `extract_confidence_values`).
+
+    Returns :
+        pd.DataFrame ou None : Tableau des pixels valides, ou None si aucun.
+    """
+    zone = os.path.basename(confidence_raster_path).split('_')[-1].replace('.tif', '')
+
+    with rasterio.open(confidence_raster_path) as src:
+        data = src.read(list(range(1, len(annees) + 1)))  # Toutes les années en une lecture
+        transform = src.transform
+
+    # Masque d'union : pixels valides au moins une année, coordonnées calculées une fois
+    valid = data != nodata
+    union = valid.any(axis=0)
+    if not union.any():
+        return None
+    rows, cols = np.where(union)
+    x, y = xy(transform, rows, cols)
+    x, y = np.array(x), np.array(y)
+    values = data[:, rows, cols]   # (années, pixels)
+    valid = valid[:, rows, cols]
+    tuile = pd.Categorical.from_codes(np.zeros(len(rows), dtype=np.int8), [zone])
+
+    if layout == 'wide':
+        df_wide = pd.DataFrame({'x': x, 'y': y, 'tuile': tuile})
+        if grid_index:
+            _add_grid_index(df_wide, rows, cols)
+        for i, annee in enumerate(annees):
+            if np.issubdtype(values.dtype, np.integer):
+                df_wide[annee] = pd.arrays.IntegerArray(values[i], ~valid[i])
+            else:
+                df_wide[annee] = np.where(valid[i], values[i], np.nan)
+        return df_wide
+
+    # Ordre identique au format long : année par année, puis pixels dans l'ordre du raster
+    band_idx, pix_idx = np.nonzero(valid)
+    df_compact = pd.DataFrame({
+        'x': x[pix_idx],
+        'y': y[pix_idx],
+        'valeur': values[band_idx, pix_idx],
+        'date': np.asarray(annees, dtype=np.int16)[band_idx],
+        'tuile': tuile.take(pix_idx),
+    })
+    if grid_index:
+        _add_grid_index(df_compact, rows[pix_idx], cols[pix_idx])
+    return df_compact
+
+
+def extract_lidar_values(lidar_raster_paths, nodata=-999, grid_index=False):
     """
     Extrait les valeurs des rasters LiDAR pour chaque métrique en supposant une même grille.
 
+    Toutes les métriques sont lues sur la grille commune et rassemblées en un seul tableau
+    large : un pixel est conservé dès qu'une métrique est valide, les métriques sans donnée
+    sont mises à NaN (même résultat que la fusion externe sur x, y, sans fusion).
+
     Args :
-        lidar_raster_paths (dict) : Dictionnaire {nom_métrique : chemin_raster}.
+        lidar_raster_paths (dict ou str) : Dictionnaire {nom_métrique : chemin_raster}, ou
+            chemin d'une pile multibande (`align_lidar_stack`) dont les bandes sont nommées
+            par métrique, lue en une seule fois.
         nodata (int) : Valeur des pixels sans données (défaut : -999).
+        grid_index (bool) : Ajoute les indices `row`, `col` et la clé `pixel_id` du pixel,
+            dans la grille LiDAR (défaut : False).
 
     Returns :
         pd.DataFrame : Tableau contenant les coordonnées x, y et une colonne pour chaque métrique.
     """
-    coords_ref = None  # Initialise le DataFrame de référence pour stocker les coordonnées et les valeurs
+    grid = _read_lidar_grid(lidar_raster_paths)
+    if grid is None:
+        return pd.DataFrame(columns=['x', 'y'])
+    metrics, data, transform, _ = grid
+
+    # Pixels valides pour au moins une métrique
+    valid = data != nodata
+    valid_mask = valid.any(axis=0)
+    rows, cols = np.where(valid_mask)
+    x, y = xy(transform, rows, cols)
+
+    df_lidar = pd.DataFrame({'x': np.array(x), 'y': np.array(y)})
+    if grid_index:
+        _add_grid_index(df_lidar, rows, cols)
+    for i, metric_name in enumerate(metrics):
+        values = data[i][valid_mask].astype(np.float32)
+        values[~valid[i][valid_mask]] = np.nan
+        df_lidar[metric_name] = values
+
+    return df_lidar
+
+
+def _read_lidar_grid(lidar_raster_paths):
+    """
+    Lit les métriques LiDAR (rasters séparés ou pile) sur leur grille commune.
+
+    Args :
+        lidar_raster_paths (dict ou str) : Dictionnaire {nom_métrique : chemin_raster} ou
+            chemin d'une pile multibande.
+
+    Returns :
+        tuple ou None : (métriques, tableau (n_métriques, lignes, colonnes), transform, crs),
+            ou None si aucun raster n'existe.
+    """
+    if isinstance(lidar_raster_paths, str):
+        if not os.path.exists(lidar_raster_paths):
+            print(f"Raster LiDAR inexistant : {lidar_raster_paths}")
+            return None
+        with rasterio.open(lidar_raster_paths) as src:
+            metrics = [desc or f"bande_{i}" for i, desc in enumerate(src.descriptions, start=1)]
+            return metrics, src.read(), src.transform, src.crs
 
-    # Boucle sur chaque métrique (clé : nom de la métrique, valeur : chemin du raster)
+    metrics, bands, transform, crs = [], [], None, None
     for metric_name, r_path in lidar_raster_paths.items():
-        # Vérifie si le fichier raster existe
         if not os.path.exists(r_path):
             print(f"Raster LiDAR inexistant : {r_path}")
             continue
-
-        # Ouvre le raster et extrait les valeurs
         with rasterio.open(r_path) as src:
-            data = src.read(1)  # Lit la première bande du raster
-            # Crée un masque pour les pixels valides (différents de nodata)
-            valid_mask = data != nodata
+            if transform is None:
+                transform, crs = src.transform, src.crs
+            elif src.transform != transform or src.crs != crs or src.shape != bands[0].shape:
+                raise ValueError(f"Grille différente des autres métriques : {r_path}")
+            bands.append(src.read(1))
+        metrics.append(metric_name)
 
-            # Identifie les indices des pixels valides
-            rows, cols = np.where(valid_mask)
+    if not bands:
+        return None
+    return metrics, np.stack(bands), transform, crs
 
-            # Convertit les indices (ligne, colonne) en coordonnées géographiques (x, y)
-            x, y = xy(src.transform, rows, cols)
 
-            # Crée un DataFrame pour la métrique en cours
-            df_metric = pd.DataFrame({
-                'x': np.array(x),         # Coordonnées x
-                'y': np.array(y),         # Coordonnées y
-                # Valeurs de la métrique pour les pixels valides
-                metric_name: data[valid_mask]
-            })
+def _grid_offset(ref_transform, ref_crs, transform, crs, tolerance=1e-6):
+    """
+    Calcule le décalage entier (lignes, colonnes) entre deux grilles de même résolution.
 
-            # Fusionne avec le DataFrame de référence
-            if coords_ref is None:
-                coords_ref = df_metric  # Initialise avec la première métrique
-            else:
-                coords_ref = coords_ref.merge(
-                    df_metric, on=['x', 'y'], how='outer')  # Fusion externe
+    Args :
+        ref_transform (Affine) : Transformation de la grille de référence.
+        ref_crs (CRS) : Système de coordonnées de la grille de référence.
+        transform (Affine) : Transformation de la grille cible.
+        crs (CRS) : Système de coordonnées de la grille cible.
+        tolerance (float) : Écart toléré, en fraction de pixel (défaut : 1e-6).
+
+    Returns :
+        tuple : (d_ligne, d_colonne) à ajouter aux indices de référence.
+    """
+    if crs != ref_crs:
+        raise ValueError(f"CRS différent de la référence : {crs} != {ref_crs}")
+    if (abs(transform.a - ref_transform.a) > tolerance * abs(ref_transform.a)
+            or abs(transform.e - ref_transform.e) > tolerance * abs(ref_transform.e)
+            or transform.b != ref_transform.b or transform.d != ref_transform.d):
+        raise ValueError("Résolution ou rotation différente de la grille de référence")
+
+    d_col = (ref_transform.c - transform.c) / ref_transform.a
+    d_row = (ref_transform.f - transform.f) / ref_transform.e
+    if abs(d_col - round(d_col)) > tolerance or abs(d_row - round(d_row)) > tolerance:
+        raise ValueError("Grille non alignée sur la grille de référence")
+    return int(round(d_row)), int(round(d_col))
+
+
+def join_lidar_values(df_pixels, reference_raster, lidar_raster_paths, nodata=-999):
+    """
+    Ajoute les métriques LiDAR aux pixels par indexation directe de la grille.
+
+    Les pixels sont repérés par leurs indices entiers `row`, `col` (ou leur clé `pixel_id`)
+    dans la grille du raster de référence (`extract_confidence_values(..., grid_index=True)`,
+    `iter_pixel_batches`) ; les rasters LiDAR,
+    alignés sur cette grille, peuvent en couvrir une fenêtre décalée d'un nombre entier de
+    pixels. Remplace la fusion gauche sur les coordonnées arrondies : un pixel hors
+    couverture ou sans donnée reçoit NaN.
+
+    Args :
+        df_pixels (pd.DataFrame) : Pixels avec les colonnes `row` et `col`, ou `pixel_id`.
+        reference_raster (str) : Raster dont la grille définit `row` et `col`.
+        lidar_raster_paths (dict ou str) : Dictionnaire {nom_métrique : chemin_raster} ou
+            chemin d'une pile multibande.
+        nodata (int) : Valeur des pixels sans données (défaut : -999).
+
+    Returns :
+        pd.DataFrame : Copie de `df_pixels` avec une colonne par métrique.
+    """
+    df_out = df_pixels.copy()
+    grid = _read_lidar_grid(lidar_raster_paths)
+    if grid is None:
+        return df_out
+    metrics, data, transform, crs = grid
+
+    with rasterio.open(reference_raster) as ref:
+        d_row, d_col = _grid_offset(ref.transform, ref.crs, transform, crs)
 
-    # Retourne le DataFrame final avec toutes les métriques
-    if coords_ref is not None:
-        return coords_ref
+    if 'row' in df_out.columns and 'col' in df_out.columns:
+        rows = df_out['row'].to_numpy(dtype=np.int64)
+        cols = df_out['col'].to_numpy(dtype=np.int64)
     else:
-        # Retourne un DataFrame vide si aucun raster n'a été traité
-        return pd.DataFrame(columns=['x', 'y'])
+        rows, cols = pixel_rowcol(df_out['pixel_id'])
+    rows, cols = rows + d_row, cols + d_col
+    inside = (rows >= 0) & (rows < data.shape[1]) & (cols >= 0) & (cols < data.shape[2])
+
+    for i, metric_name in enumerate(metrics):
+        values = np.full(len(df_out), np.nan, dtype=np.float32)
+        gathered = data[i][rows[inside], cols[inside]]
+        values[inside] = np.where(gathered != nodata, gathered, np.nan)
+        df_out[metric_name] = values
+
+    return df_out
 
 
-def jointure_parcelle(df_pixels, peupleraies_merged):
+def pixel_keys_from_xy(coords, confidence_rasters, tolerance=0.01):
     """
-    Réalise une jointure spatiale à l'échelle des parcelles.
+    Convertit des coordonnées de centres de pixels en clés entières (tuile, pixel_id).
+
+    Chaque point est cherché dans la grille de chaque tuile ; la conversion est faite une
+    fois, les exclusions portant ensuite sur des entiers. Un point d'une tuile qui n'est
+    pas le centre d'un pixel (coordonnée mal saisie) est signalé et ignoré, pour ne pas
+    exclure un pixel voisin.
+
+    Args :
+        coords (list) : Coordonnées (x, y) des centres de pixels.
+        confidence_rasters (dict) : {tuile : chemin du raster de confiance découpé}.
+        tolerance (float) : Écart maximal au centre, en fraction de pixel sur chaque axe
+            (défaut : 0.01, soit 10 cm pour des pixels de 10 m).
+
+    Returns :
+        list : Tuples (tuile, pixel_id) des pixels trouvés.
+    """
+    if not coords:
+        return []
+    xs, ys = np.asarray(coords, dtype=np.float64).T
+    keys = []
+    for zone, raster_path in confidence_rasters.items():
+        if not os.path.exists(raster_path):
+            continue
+        with rasterio.open(raster_path) as src:
+            cols_f, rows_f = ~src.transform * (xs, ys)
+            height, width = src.height, src.width
+        rows, cols = np.floor(rows_f).astype(np.int64), np.floor(cols_f).astype(np.int64)
+        inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+        centre = ((np.abs(rows_f - rows - 0.5) < tolerance)
+                  & (np.abs(cols_f - cols - 0.5) < tolerance))
+        for i in np.flatnonzero(inside & ~centre):
+            print(f"Point ({xs[i]}, {ys[i]}) ignoré : pas un centre de pixel de la tuile {zone}")
+        ok = inside & centre
+        keys.extend((zone, int(pid)) for pid in pixel_id(rows[ok], cols[ok]))
+    return keys
+
+
+def masque_pixels(df, pixel_keys):
+    """
+    Repère les lignes dont la clé (tuile, pixel_id) figure dans la liste.
+
+    Args :
+        df (pd.DataFrame) : Tableau avec les colonnes `tuile` et `pixel_id`.
+        pixel_keys (list) : Tuples (tuile, pixel_id) (`pixel_keys_from_xy`).
+
+    Returns :
+        np.ndarray : Masque booléen, True pour les lignes dont la clé est listée.
+    """
+    if not pixel_keys:
+        return np.zeros(len(df), dtype=bool)
+    keys = pd.MultiIndex.from_tuples(pixel_keys, names=['tuile', 'pixel_id'])
+    index = pd.MultiIndex.from_arrays([df['tuile'], df['pixel_id'].astype(np.int64)])
+    return index.isin(keys)
+
+
+def exclure_pixels(df, pixel_keys):
+    """
+    Supprime les lignes dont la clé (tuile, pixel_id) figure dans la liste.
+
+    Args :
+        df (pd.DataFrame) : Tableau avec les colonnes `tuile` et `pixel_id`.
+        pixel_keys (list) : Tuples (tuile, pixel_id) à exclure (`pixel_keys_from_xy`).
+
+    Returns :
+        pd.DataFrame : Tableau filtré.
+    """
+    if not pixel_keys:
+        return df
+    return df[~masque_pixels(df, pixel_keys)]
+
+
+def _open_lidar_sources(lidar_raster_paths, stack):
+    """
+    Ouvre les rasters LiDAR (séparés ou pile) sans les lire.
+
+    Args :
+        lidar_raster_paths (dict, str ou None) : Dictionnaire {nom_métrique : chemin_raster},
+            chemin d'une pile multibande, ou None.
+        stack (ExitStack) : Pile de contextes qui fermera les rasters.
+
+    Returns :
+        list : Tuples (nom_métrique, dataset, indice_bande).
+    """
+    if not lidar_raster_paths:
+        return []
+    if isinstance(lidar_raster_paths, str):
+        if not os.path.exists(lidar_raster_paths):
+            print(f"Raster LiDAR inexistant : {lidar_raster_paths}")
+            return []
+        src = stack.enter_context(rasterio.open(lidar_raster_paths))
+        return [(desc or f"bande_{i}", src, i) for i, desc in enumerate(src.descriptions, start=1)]
+
+    sources = []
+    for metric_name, r_path in lidar_raster_paths.items():
+        if not os.path.exists(r_path):
+            print(f"Raster LiDAR inexistant : {r_path}")
+            continue
+        sources.append((metric_name, stack.enter_context(rasterio.open(r_path)), 1))
+    return sources
+
+
+def _read_shifted(src, bidx, row_off, col_off, height, width, fill_value):
+    """
+    Lit une fenêtre pouvant déborder du raster, complétée par `fill_value`.
+
+    Args :
+        src (DatasetReader) : Raster ouvert.
+        bidx (int) : Indice de la bande.
+        row_off, col_off (int) : Origine de la fenêtre dans la grille du raster.
+        height, width (int) : Taille de la fenêtre.
+        fill_value (float) : Valeur hors du raster.
+
+    Returns :
+        np.ndarray : Tableau (height, width).
+    """
+    block = np.full((height, width), fill_value, dtype=src.dtypes[bidx - 1])
+    r0, c0 = max(row_off, 0), max(col_off, 0)
+    r1, c1 = min(row_off + height, src.height), min(col_off + width, src.width)
+    if r1 > r0 and c1 > c0:
+        block[r0 - row_off:r1 - row_off, c0 - col_off:c1 - col_off] = src.read(
+            bidx, window=Window(c0, r0, c1 - c0, r1 - r0))
+    return block
+
+
+def iter_pixel_batches(confidence_raster_path, annees, lidar_raster_paths=None, nodata=-999,
+                       lidar_nodata=-999, batch_rows=256, grid_index=False):
+    """
+    Parcourt une tuile par bandes de lignes et produit les pixels joints aux métriques LiDAR.
+
+    Chaque lot couvre `batch_rows` lignes du raster de confiance : seules ces lignes, et la
+    fenêtre correspondante des rasters LiDAR alignés, sont en mémoire. Les colonnes sont
+    celles de `extract_confidence_values`, la clé `pixel_id`, puis une colonne par métrique
+    (NaN hors couverture LiDAR ou sans donnée) ; dans un lot, les lignes sont rangées par
+    année puis dans l'ordre du raster.
+
+    Args :
+        confidence_raster_path (str) : Chemin vers le raster de confiance multibande.
+        annees (list) : Liste des années correspondant aux bandes.
+        lidar_raster_paths (dict ou str) : Dictionnaire {nom_métrique : chemin_raster}, chemin
+            d'une pile multibande, ou None pour la confiance seule (défaut : None).
+        nodata (int) : Valeur sans données du raster de confiance (défaut : -999).
+        lidar_nodata (int) : Valeur sans données des rasters LiDAR (défaut : -999).
+        batch_rows (int) : Nombre de lignes raster par lot, qui borne la mémoire (défaut : 256).
+        grid_index (bool) : Ajoute les indices entiers `row` et `col` du pixel ; la clé
+            `pixel_id` est toujours présente (défaut : False).
+
+    Yields :
+        pd.DataFrame : Lot de pixels valides, jamais vide, typé selon `SCHEMA`.
+    """
+    if not os.path.exists(confidence_raster_path):
+        print(f"Raster inexistant : {confidence_raster_path}")
+        return
+
+    zone = os.path.basename(confidence_raster_path).split('_')[-1].replace('.tif', '')
+    dates = np.asarray(annees)
+
+    with ExitStack() as stack:
+        src = stack.enter_context(rasterio.open(confidence_raster_path))
+        lidar = [(metric_name, l_src, bidx,
+                  _grid_offset(src.transform, src.crs, l_src.transform, l_src.crs))
+                 for metric_name, l_src, bidx in _open_lidar_sources(lidar_raster_paths, stack)]
+        bands = list(range(1, len(annees) + 1))
+
+        for row_off in range(0, src.height, batch_rows):
+            height = min(batch_rows, src.height - row_off)
+            data = src.read(bands, window=Window(0, row_off, src.width, height))
+
+            band_idx, rows, cols = np.nonzero(data != nodata)
+            if len(band_idx) == 0:
+                continue
+            x, y = xy(src.transform, rows + row_off, cols)
+
+            df_batch = pd.DataFrame({
+                'x': np.array(x),
+                'y': np.array(y),
+                'valeur': data[band_idx, rows, cols],
+                'date': dates[band_idx],
+                'tuile': zone,
+                'pixel_id': pixel_id(rows + row_off, cols)
+            })
+            if grid_index:
+                df_batch.insert(5, 'row', (rows + row_off).astype(np.int32))
+                df_batch.insert(6, 'col', cols.astype(np.int32))
+
+            # Fenêtre LiDAR correspondante, décalée d'un nombre entier de pixels
+            for metric_name, l_src, bidx, (d_row, d_col) in lidar:
+                block = _read_shifted(l_src, bidx, row_off + d_row, d_col,
+                                      height, src.width, lidar_nodata)
+                values = block[rows, cols]
+                df_batch[metric_name] = np.where(
+                    values != lidar_nodata, values, np.nan).astype(np.float32)
+
+            yield apply_schema(df_batch)
+
+
+def write_pixel_batches(batches, dataset_path, prefix):
+    """
+    Ajoute des lots de pixels à un jeu de données Parquet au fur et à mesure.
+
+    Args :
+        batches (iterable) : Lots de pixels (ex. `iter_pixel_batches`, éventuellement joints
+            aux parcelles lot par lot).
+        dataset_path (str) : Répertoire du jeu de données.
+        prefix (str) : Préfixe des fichiers écrits, unique par tuile (ex. nom de la tuile).
+
+    Returns :
+        int : Nombre total de lignes écrites.
+    """
+    n_rows = 0
+    for i, df_batch in enumerate(batches):
+        if df_batch is None or df_batch.empty:
+            continue
+        append_table(df_batch, dataset_path, f"{prefix}-{i:05d}")
+        n_rows += len(df_batch)
+    return n_rows
+
+
+def tile_bounds(reference_raster, crs=None):
+    """
+    Renvoie l'emprise d'une tuile, éventuellement reprojetée dans un autre système.
+
+    Args :
+        reference_raster (str) : Raster définissant la tuile (ex : confiance découpée).
+        crs (optional) : Système de coordonnées cible ; celui du raster si None.
+
+    Returns :
+        tuple : (xmin, ymin, xmax, ymax) couvrant toute la tuile.
+    """
+    with rasterio.open(reference_raster) as src:
+        bounds, src_crs = tuple(src.bounds), src.crs
+    if crs is None or CRS.from_user_input(crs) == src_crs:
+        return bounds
+    # Bords densifiés : l'emprise reprojetée contient toute la tuile
+    return transform_bounds(src_crs, crs, *bounds, densify_pts=21)
+
+
+# Parcelles lues par tuile, par processus : {(chemin, couche, emprise, taille, mtime) : GeoDataFrame}
+_TILE_PARCELS = {}
+# Nombre de tuiles gardées en mémoire ; au-delà, la moins récemment utilisée est retirée
+_TILE_PARCELS_MAX = 16
+
+
+def load_tile_parcels(gpkg_path, layer, reference_raster):
+    """
+    Charge les seules parcelles d'une couche qui recouvrent l'emprise d'une tuile.
+
+    La lecture par emprise s'appuie sur l'index R-tree du GeoPackage : le coût ne dépend
+    que des parcelles de la tuile, pas de la taille de la couche. Le sous-ensemble et son
+    arbre STR (`sindex`) sont gardés en mémoire par processus tant que le GeoPackage ne
+    change pas, pour les `_TILE_PARCELS_MAX` tuiles les plus récemment utilisées. Les
+    parcelles conservent l'ordre de la couche ; les jointures et les statistiques zonales
+    donnent donc les mêmes résultats qu'avec la couche entière.
+
+    Args :
+        gpkg_path (str) : Chemin du GeoPackage des parcelles.
+        layer (str) : Nom de la couche.
+        reference_raster (str) : Raster définissant la tuile (ex : confiance découpée).
+
+    Returns :
+        gpd.GeoDataFrame : Parcelles de la tuile, partagées par le cache (ne pas modifier).
+    """
+    layer_crs = pyogrio.read_info(gpkg_path, layer=layer)['crs']
+    bounds = tile_bounds(reference_raster, layer_crs)
+    stat = os.stat(gpkg_path)
+    key = (os.path.abspath(gpkg_path), layer, bounds, stat.st_size, stat.st_mtime_ns)
+    if key in _TILE_PARCELS:
+        # Réinsertion en fin de dictionnaire : entrée la plus récemment utilisée
+        _TILE_PARCELS[key] = _TILE_PARCELS.pop(key)
+        return _TILE_PARCELS[key]
+
+    # La lecture par R-tree ne suit pas l'ordre de la couche : il est rétabli par FID
+    parcelles = gpd.read_file(gpkg_path, layer=layer, bbox=bounds, fid_as_index=True)
+    # Index sans nom : `sjoin` le reporte en 'index_right', retiré des sorties
+    parcelles = parcelles.sort_index().rename_axis(None)
+    # Index spatial construit une fois, réutilisé par `sjoin` à chaque lot de pixels
+    parcelles.sindex
+
+    _TILE_PARCELS[key] = parcelles
+    while len(_TILE_PARCELS) > _TILE_PARCELS_MAX:
+        del _TILE_PARCELS[next(iter(_TILE_PARCELS))]
+    return parcelles
+
+
+def _preparer_lot(lot, lidar_metrics):
+    """
+    Prépare un lot de pixels pour l'export avant les jointures.
+
+    Args :
+        lot (pd.DataFrame) : Lot issu de `iter_pixel_batches`.
+        lidar_metrics (list) : Métriques attendues ; les absentes sont ajoutées à NaN.
+
+    Returns :
+        pd.DataFrame : Lot modifié sur place.
+    """
+    # Arrondi des coordonnées pour l'export
+    lot['x'] = lot['x'].round(2)
+    lot['y'] = lot['y'].round(2)
+    for metric in lidar_metrics:
+        if metric not in lot.columns:
+            lot[metric] = np.float32(np.nan)
+    return lot
+
+
+def _extract_tile_job(zone, conf_raster, lidar_raster_paths, annees, lidar_metrics, jointures,
+                      nodata, batch_rows, gdal_cache_mb):
+    """
+    Extrait une tuile en une lecture, la joint à chaque couche de parcelles et l'écrit.
+
+    Args :
+        zone (str) : Tuile traitée.
+        conf_raster (str) : Raster de confiance découpé de la tuile.
+        lidar_raster_paths (dict ou str) : Rasters LiDAR de la tuile (vide si aucun).
+        annees (list) : Années des bandes de confiance.
+        lidar_metrics (list) : Métriques attendues dans la sortie 'pixel'.
+        jointures (dict) : {échelle : (chemin_gpkg, couche, jeu_de_données)}.
+        nodata (int) : Valeur sans données des rasters.
+        batch_rows (int) : Lignes raster par lot.
+        gdal_cache_mb (int) : Budget du cache GDAL (Mo) pour ce worker.
+
+    Returns :
+        dict : 'zone', 'rows' ({échelle : lignes écrites}), 'duration' (s) et 'error'
+        (None si succès).
+    """
+    record = {'zone': zone, 'rows': {echelle: 0 for echelle in jointures},
+              'duration': None, 'error': None}
+    debut = time.perf_counter()
+    try:
+        with rasterio.Env(GDAL_CACHEMAX=gdal_cache_mb):
+            # Seules les parcelles recouvrant la tuile sont lues (index R-tree du GeoPackage) ;
+            # sans raster de confiance, `iter_pixel_batches` ne produit aucun lot
+            peupleraies, label_grids = {}, {}
+            if os.path.exists(conf_raster):
+                peupleraies = {echelle: load_tile_parcels(path, layer, conf_raster)
+                               for echelle, (path, layer, _) in jointures.items()}
+                # Grille d'étiquettes rasterisée une fois par tuile, réutilisée par chaque lot
+                label_grids = {echelle: build_parcel_labels(parcelles, conf_raster)
+                               for echelle, parcelles in peupleraies.items()}
+
+            # Le worker ne réécrit que la partition de sa tuile
+            for _, _, dataset_path in jointures.values():
+                shutil.rmtree(os.path.join(dataset_path, f"tuile={zone}"), ignore_errors=True)
+
+            # Une seule lecture des rasters, chaque lot servant à toutes les jointures
+            lots = iter_pixel_batches(conf_raster, annees, lidar_raster_paths, nodata=nodata,
+                                      lidar_nodata=nodata, batch_rows=batch_rows)
+            for i, lot in enumerate(lots):
+                lot = _preparer_lot(lot, lidar_metrics)
+                for echelle, (_, _, dataset_path) in jointures.items():
+                    # Les métriques LiDAR ne sont conservées qu'à l'échelle pixel
+                    colonnes = lot.columns if echelle == 'pixel' else COLONNES_PIXELS
+                    df_joint = JOINTURES[echelle](lot[colonnes], peupleraies[echelle],
+                                                  label_grid=label_grids[echelle])
+                    df_joint = apply_schema(df_joint)
+                    if not df_joint.empty:
+                        append_table(df_joint, dataset_path, f"{zone}-{i:05d}")
+                        record['rows'][echelle] += len(df_joint)
+    except Exception:
+        record['error'] = traceback.format_exc()
+    record['duration'] = time.perf_counter() - debut
+    return record
+
+
+def extract_tiles_parallel(zones, annees, output_dir_confidence, jointures,
+                           output_dir_lidar=None, lidar_metrics=(), lidar_exclude=(),
+                           lidar_stack=False, nodata=-999, batch_rows=256, max_workers=None,
+                           gdal_cache_mb=256, overwrite=True):
+    """
+    Lance l'extraction et les jointures des tuiles sur un pool de processus.
+
+    Chaque tuile est traitée par un worker qui lit ses rasters une seule fois
+    (`iter_pixel_batches`) et joint chaque lot à toutes les couches de parcelles
+    demandées, écrivant directement la partition `tuile=<zone>` de chaque jeu de données
+    Parquet. Les fichiers sont nommés par tuile et numéro de lot : les tableaux combinés,
+    relus avec `read_table`, ont un ordre de lignes déterministe, indépendant de l'ordre
+    d'achèvement.
+
+    Args :
+        zones (list) : Liste des tuiles à traiter.
+        annees (list) : Liste des années des bandes de confiance.
+        output_dir_confidence (str) : Répertoire des rasters `confidence_clipped_<zone>.tif`.
+        jointures (dict) : {échelle : (chemin_gpkg, couche, jeu_de_données)}, l'échelle étant
+            'parcelle' (`jointure_parcelle`, sans métriques LiDAR) ou 'pixel'
+            (`jointure_pixel`, avec les métriques LiDAR).
+        output_dir_lidar (str, optional) : Répertoire des rasters LiDAR découpés.
+        lidar_metrics (list, optional) : Métriques LiDAR (ex. 'grid_CC') ; colonnes à NaN
+            pour les tuiles sans LiDAR.
+        lidar_exclude (iterable, optional) : Tuiles sans métriques LiDAR (ex. 'T31UEP').
+        lidar_stack (bool, optional) : Lit la pile `lidar_stack_clipped_<zone>.tif` au lieu
+            des rasters par métrique.
+        nodata (int, optional) : Valeur sans données des rasters (défaut : -999).
+        batch_rows (int, optional) : Lignes raster par lot (défaut : 256).
+        max_workers (int, optional) : Nombre de processus (défaut : nombre de cœurs).
+        gdal_cache_mb (int, optional) : Cache GDAL alloué à chaque worker en Mo (défaut : 256).
+        overwrite (bool, optional) : Supprime les jeux de données existants avant
+            l'extraction ; sinon, seules les partitions des tuiles traitées sont remplacées
+            (défaut : True).
+
+    Returns :
+        list : Un dictionnaire par tuile ('zone', 'rows' par échelle, 'duration', 'error'),
+        dans l'ordre de `zones`.
+    """
+    inconnues = set(jointures) - set(JOINTURES)
+    if inconnues:
+        raise ValueError(f"Échelle(s) inconnue(s) : {sorted(inconnues)} "
+                         f"(attendu : 'parcelle' ou 'pixel')")
+    for _, _, dataset_path in jointures.values():
+        if overwrite and os.path.isdir(dataset_path):
+            shutil.rmtree(dataset_path)
+        os.makedirs(dataset_path, exist_ok=True)
+
+    # Les métriques LiDAR ne sont utiles qu'à la sortie pixel
+    avec_lidar = output_dir_lidar and 'pixel' in jointures
+
+    records = []
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = []
+        for zone in zones:
+            conf_raster = os.path.join(output_dir_confidence, f"confidence_clipped_{zone}.tif")
+
+            # Rasters LiDAR de la tuile (aucun pour les tuiles exclues)
+            lidar_raster_paths = {}
+            if avec_lidar and zone not in lidar_exclude:
+                if lidar_stack:
+                    lidar_raster_paths = os.path.join(output_dir_lidar,
+                                                      f"lidar_stack_clipped_{zone}.tif")
+                else:
+                    lidar_raster_paths = {
+                        metric: os.path.join(output_dir_lidar, f"{metric}_clipped_{zone}.tif")
+                        for metric in lidar_metrics}
+
+            futures.append(pool.submit(
+                _extract_tile_job, zone, conf_raster, lidar_raster_paths, annees,
+                list(lidar_metrics) if 'pixel' in jointures else [], dict(jointures),
+                nodata, batch_rows, gdal_cache_mb))
+
+        for future in as_completed(futures):
+            records.append(future.result())
+
+    # Ordre déterministe des enregistrements : celui des zones
+    records.sort(key=lambda r: zones.index(r['zone']))
+    for record in records:
+        statut = 'OK' if record['error'] is None else 'ERREUR'
+        lignes = ', '.join(f"{echelle} {n} lignes" for echelle, n in record['rows'].items())
+        print(f"{record['zone']} : {statut}, {lignes} ({record['duration']:.1f} s)")
+    return records
+
+
+def build_parcel_labels(peupleraies_merged, reference_raster):
+    """
+    Rasterise l'index des parcelles sur la grille d'un raster de référence (tuile).
+
+    Chaque pixel reçoit la position (0..n-1) de la parcelle qui contient son centre et
+    -1 hors parcelle. Les pixels ambigus reçoivent -2 : recouvrement de parcelles ou
+    pixel traversé par une limite de parcelle (son centre peut être sur la limite). Ils
+    sont joints par jointure spatiale classique pour rester identiques à `sjoin`.
 
     Args :
-        df_pixels (pd.DataFrame) : pixels avec coordonnées x et y.
         peupleraies_merged (gpd.GeoDataFrame) : parcelles avec géométrie.
+        reference_raster (str) : Chemin du raster définissant la grille (ex : confiance découpée).
 
     Returns :
-        pd.DataFrame : données jointes contenant les colonnes pertinentes.
+        tuple : (labels, transform), labels étant un np.ndarray int32 de la taille de la grille.
     """
-    # Conversion en GeoDataFrame avec géométrie basée sur x, y
-    gdf_pixels = gpd.GeoDataFrame(
-        df_pixels,
-        geometry=gpd.points_from_xy(df_pixels['x'], df_pixels['y']),
-        crs=peupleraies_merged.crs
+    with rasterio.open(reference_raster) as ref:
+        out_shape = (ref.height, ref.width)
+        transform = ref.transform
+
+    geoms = peupleraies_merged.geometry.values
+    valid = ~(geoms.isna() | geoms.is_empty)
+    positions = np.flatnonzero(valid)
+
+    labels = np.full(out_shape, -1, dtype=np.int32)
+    if positions.size == 0:
+        return labels, transform
+
+    labels = rasterize(
+        ((geoms[i], int(i)) for i in positions),
+        out_shape=out_shape, transform=transform, fill=-1, dtype='int32'
     )
 
-    # Jointure spatiale entre les pixels et les parcelles
-    gdf_joined = sjoin(gdf_pixels, peupleraies_merged,
-                       how='left', predicate='intersects')
+    # Nombre de parcelles par pixel pour repérer les recouvrements
+    counts = rasterize(
+        ((geoms[i], 1) for i in positions),
+        out_shape=out_shape, transform=transform, fill=0, dtype='uint16',
+        merge_alg=MergeAlg.add
+    )
+    labels[counts > 1] = -2
+
+    # Pixels traversés par une limite : centre potentiellement sur la limite
+    bordures = rasterize(
+        ((geoms[i].boundary, 1) for i in positions),
+        out_shape=out_shape, transform=transform, fill=0, dtype='uint8',
+        all_touched=True
+    )
+    labels[bordures == 1] = -2
+
+    return labels, transform
+
+
+def _lookup_labels(df_pixels, label_grid):
+    """
+    Retourne l'étiquette de parcelle de chaque pixel par indexation directe de la grille.
+
+    Args :
+        df_pixels (pd.DataFrame) : pixels avec coordonnées x et y (centres de pixels).
+        label_grid (tuple) : (labels, transform) issu de `build_parcel_labels`.
+
+    Returns :
+        np.ndarray : Étiquette par pixel (-1 hors grille ou hors parcelle).
+    """
+    labels, transform = label_grid
+    cols, rows = ~transform * (df_pixels['x'].to_numpy(dtype=np.float64),
+                               df_pixels['y'].to_numpy(dtype=np.float64))
+    rows = np.floor(rows).astype(np.int64)
+    cols = np.floor(cols).astype(np.int64)
+
+    inside = (rows >= 0) & (rows < labels.shape[0]) & (cols >= 0) & (cols < labels.shape[1])
+    lab = np.full(len(df_pixels), -1, dtype=np.int32)
+    lab[inside] = labels[rows[inside], cols[inside]]
+    return lab
+
+
+def _jointure_spatiale(df_pixels, peupleraies_merged, label_grid=None):
+    """
+    Joint chaque pixel à la parcelle qui le contient (équivalent d'un `sjoin` left/intersects).
+
+    Sans grille d'étiquettes, les pixels sont convertis en points et joints par `sjoin`.
+    Avec une grille (`build_parcel_labels`), les attributs sont rattachés par indexation de
+    tableaux, sans objets géométriques ; seuls les pixels ambigus (recouvrements, limites
+    de parcelles) passent par `sjoin`.
+
+    Args :
+        df_pixels (pd.DataFrame) : pixels avec coordonnées x et y.
+        peupleraies_merged (gpd.GeoDataFrame) : parcelles avec géométrie.
+        label_grid (tuple, optional) : (labels, transform) de la tuile.
+
+    Returns :
+        pd.DataFrame : pixels joints, colonnes homonymes suffixées '_left'/'_right'.
+    """
+    if label_grid is None:
+        # Conversion en GeoDataFrame avec géométrie basée sur x, y
+        gdf_pixels = gpd.GeoDataFrame(
+            df_pixels,
+            geometry=gpd.points_from_xy(df_pixels['x'], df_pixels['y']),
+            crs=peupleraies_merged.crs
+        )
+
+        # Jointure spatiale entre les pixels et les parcelles
+        return sjoin(gdf_pixels, peupleraies_merged, how='left', predicate='intersects')
+
+    lab = _lookup_labels(df_pixels, label_grid)
+    overlap = lab == -2
+
+    # Attributs des parcelles, avec les mêmes suffixes que sjoin en cas de conflit
+    attrs = pd.DataFrame(peupleraies_merged.drop(columns=peupleraies_merged.geometry.name))
+    communs = [c for c in attrs.columns if c in df_pixels.columns]
+    left = df_pixels.rename(columns={c: f"{c}_left" for c in communs})
+    right = attrs.rename(columns={c: f"{c}_right" for c in communs})
+    right.insert(0, 'index_right', attrs.index)
+
+    # Indexation positionnelle : -1 (hors parcelle) donne une ligne de NaN comme sjoin
+    right = right.reset_index(drop=True).reindex(lab[~overlap])
+    right.index = left.index[~overlap]
+    joined = pd.concat([left[~overlap], right], axis=1)
+
+    if overlap.any():
+        joined_overlap = _jointure_spatiale(df_pixels[overlap], peupleraies_merged)
+        joined_overlap = pd.DataFrame(joined_overlap.drop(columns='geometry'))
+        joined = pd.concat([joined, joined_overlap])
+        # Retrouver l'ordre des pixels d'entrée (tri stable sur l'index)
+        joined = joined.iloc[np.argsort(
+            df_pixels.index.get_indexer(joined.index), kind='stable')]
+
+    return joined
+
+
+def _pixel_parcel_pairs(labels, transform, peupleraies_merged):
+    """
+    Associe les pixels de la grille aux parcelles qui contiennent leur centre.
+
+    Les pixels non ambigus sont lus dans la grille d'étiquettes ; les pixels ambigus (-2)
+    sont testés par point dans polygone (arbre STR), un pixel couvert par plusieurs
+    parcelles comptant pour chacune, comme avec `sjoin`.
+
+    Args :
+        labels (np.ndarray) : Grille d'étiquettes de `build_parcel_labels`.
+        transform (Affine) : Transformation de la grille.
+        peupleraies_merged (gpd.GeoDataFrame) : parcelles avec géométrie.
+
+    Returns :
+        tuple : (pixels, parcelles) : indices à plat dans la grille et positions des parcelles.
+    """
+    flat = labels.ravel()
+    pixels = np.flatnonzero(flat >= 0)
+    parcelles = flat[pixels].astype(np.int64)
+
+    ambigus = np.flatnonzero(flat == -2)
+    if ambigus.size:
+        rows, cols = np.divmod(ambigus, labels.shape[1])
+        x, y = xy(transform, rows, cols)
+        # Arbre STR des parcelles, déjà construit si elles viennent de `load_tile_parcels`
+        idx_pts, idx_parc = peupleraies_merged.sindex.query(
+            shapely.points(np.array(x), np.array(y)), predicate='intersects')
+        pixels = np.concatenate([pixels, ambigus[idx_pts]])
+        parcelles = np.concatenate([parcelles, idx_parc.astype(np.int64)])
+
+    return pixels, parcelles
+
+
+def _group_quantiles(sorted_values, starts, counts, q):
+    """
+    Calcule un quantile par groupe sur des valeurs triées par groupe (interpolation linéaire).
+
+    Args :
+        sorted_values (np.ndarray) : Valeurs triées par groupe puis par valeur.
+        starts (np.ndarray) : Début de chaque groupe non vide.
+        counts (np.ndarray) : Effectif de chaque groupe non vide.
+        q (float) : Quantile entre 0 et 1.
+
+    Returns :
+        np.ndarray : Quantile de chaque groupe.
+    """
+    pos = q * (counts - 1)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.ceil(pos).astype(np.int64)
+    v_lo = sorted_values[starts + lo]
+    v_hi = sorted_values[starts + hi]
+    return v_lo + (v_hi - v_lo) * (pos - lo)
+
+
+def _quantile_names(quantiles):
+    """
+    Nomme les colonnes des quantiles : 'q25' pour 0.25, 'q25_1' pour 0.251.
+
+    Args :
+        quantiles (tuple) : Quantiles demandés en plus de la médiane, dans [0, 1].
+
+    Returns :
+        list : Couples (nom, quantile), dans l'ordre de `quantiles`.
+    """
+    names = []
+    for q in quantiles:
+        if not 0 <= q <= 1:
+            raise ValueError(f"Quantile hors de [0, 1] : {q}")
+        pct = round(q * 100, 6)
+        name = f"q{int(pct):02d}" if pct == int(pct) else f"q{pct:g}".replace('.', '_')
+        names.append((name, q))
+
+    # Un nom répété écraserait silencieusement une statistique
+    noms = ['median'] + [name for name, _ in names]
+    doublons = sorted({name for name in noms if noms.count(name) > 1})
+    if doublons or 0.5 in quantiles:
+        raise ValueError(f"Quantiles en double (la médiane 0.5 est toujours calculée) : "
+                         f"{list(quantiles)}")
+    return names
+
+
+def _zonal_reduce(values, groups, n_groups, quantiles):
+    """
+    Réduit des valeurs par groupe : effectif, moyenne, médiane, écart-type et quantiles.
+
+    Args :
+        values (np.ndarray) : Valeurs valides (float64).
+        groups (np.ndarray) : Groupe (0..n_groups-1) de chaque valeur.
+        n_groups (int) : Nombre de groupes.
+        quantiles (tuple) : Quantiles à calculer en plus de la médiane.
+
+    Returns :
+        dict : {statistique : np.ndarray de longueur n_groups}, NaN pour les groupes vides.
+    """
+    count = np.bincount(groups, minlength=n_groups)
+    total = np.bincount(groups, weights=values, minlength=n_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+        # Écart-type corrigé (ddof=1, comme pandas), sur les écarts à la moyenne du groupe
+        sq = np.bincount(groups, weights=(values - mean[groups]) ** 2, minlength=n_groups)
+        std = np.sqrt(sq / (count - 1))
+    std[count < 2] = np.nan
+
+    stats = {'count': count, 'mean': mean, 'std': std}
+    order = np.lexsort((values, groups))
+    sorted_values = values[order]
+    present = count > 0
+    starts = (np.cumsum(count) - count)[present]
+    for name, q in [('median', 0.5)] + _quantile_names(quantiles):
+        result = np.full(n_groups, np.nan)
+        result[present] = _group_quantiles(sorted_values, starts, count[present], q)
+        stats[name] = result
+    return stats
+
+
+def zonal_statistics(confidence_raster_path, annees, peupleraies_merged, lidar_raster_paths=None,
+                     nodata=-999, lidar_nodata=-999, quantiles=(0.25, 0.75), label_grid=None):
+    """
+    Calcule les statistiques par parcelle et par année directement dans l'espace raster.
+
+    Les pixels sont rattachés aux parcelles par la grille d'étiquettes
+    (`build_parcel_labels`), puis les valeurs de confiance et les métriques LiDAR sont
+    réduites par (parcelle, année) avec `bincount` et un tri par groupe, sans tableau
+    par pixel. Comme dans le tableau pixel, une métrique LiDAR n'est comptée pour une année
+    que si la confiance du pixel est valide cette année-là.
+
+    Args :
+        confidence_raster_path (str) : Chemin vers le raster de confiance multibande.
+        annees (list) : Liste des années correspondant aux bandes.
+        peupleraies_merged (gpd.GeoDataFrame) : parcelles avec géométrie.
+        lidar_raster_paths (dict ou str, optional) : Dictionnaire {nom_métrique : chemin_raster}
+            ou chemin d'une pile multibande, alignés sur la grille de confiance.
+        nodata (int) : Valeur sans données du raster de confiance (défaut : -999).
+        lidar_nodata (int) : Valeur sans données des rasters LiDAR (défaut : -999).
+        quantiles (tuple) : Quantiles calculés en plus de la médiane, sans 0.5 ni doublon
+            (défaut : (0.25, 0.75)).
+        label_grid (tuple, optional) : (labels, transform) déjà calculé pour la tuile.
+
+    Returns :
+        pd.DataFrame ou None : Une ligne par parcelle et par année ayant au moins un pixel
+            valide : attributs de la parcelle, date, tuile, age_plan, puis pour `valeur` et
+            chaque métrique les colonnes `<variable>_count`, `_mean`, `_median`, `_std` et
+            `_qNN` (`_qNN_D` pour un centile non entier, ex. 0.251 -> `_q25_1`).
+    """
+    # Noms des quantiles vérifiés avant toute lecture
+    _quantile_names(quantiles)
+    if not os.path.exists(confidence_raster_path):
+        print(f"Raster inexistant : {confidence_raster_path}")
+        return None
+
+    zone = os.path.basename(confidence_raster_path).split('_')[-1].replace('.tif', '')
+    if label_grid is None:
+        label_grid = build_parcel_labels(peupleraies_merged, confidence_raster_path)
+    labels, transform = label_grid
+    pixels, parcelles = _pixel_parcel_pairs(labels, transform, peupleraies_merged)
+    n_parc = len(peupleraies_merged)
+
+    with ExitStack() as stack:
+        src = stack.enter_context(rasterio.open(confidence_raster_path))
+        conf = src.read(list(range(1, len(annees) + 1))).reshape(len(annees), -1)[:, pixels]
+
+        # Métriques LiDAR ramenées sur la grille de confiance, seulement aux pixels utiles
+        variables = {}
+        for metric_name, l_src, bidx in _open_lidar_sources(lidar_raster_paths, stack):
+            d_row, d_col = _grid_offset(src.transform, src.crs, l_src.transform, l_src.crs)
+            block = _read_shifted(l_src, bidx, d_row, d_col, src.height, src.width,
+                                  lidar_nodata)
+            variables[metric_name] = block.ravel()[pixels]
+
+    results = []
+    for i, annee in enumerate(annees):
+        valid = conf[i] != nodata
+        if not valid.any():
+            continue
+        parc_annee = parcelles[valid]
+        stats = {'valeur': _zonal_reduce(conf[i][valid].astype(np.float64),
+                                         parc_annee, n_parc, quantiles)}
+        for metric_name, values in variables.items():
+            values = values[valid]
+            ok = values != lidar_nodata
+            stats[metric_name] = _zonal_reduce(values[ok].astype(np.float64),
+                                               parc_annee[ok], n_parc, quantiles)
+
+        present = np.flatnonzero(stats['valeur']['count'] > 0)
+        df_annee = pd.DataFrame({'position': present, 'date': annee, 'tuile': zone})
+        for variable, var_stats in stats.items():
+            for name, values in var_stats.items():
+                df_annee[f"{variable}_{name}"] = values[present]
+        results.append(df_annee)
 
-    # Sélection des colonnes
-    cols = [
-        'unique_id', 'id_parc', 'annee_plan', 'cultivar', 'cultivar_n',
-        'source', 'PAI_GF_mean', 'VCI_mean', 'CC', 'MOCH', 'ENL',
-        'Z_mean', 'densite', 'biomass_mean', 'lidar_date'
-    ]
+    if not results:
+        return None
+
+    # Attributs des parcelles par position, puis âge de la plantation comme pour les pixels
+    df_stats = pd.concat(results, ignore_index=True)
+    attrs = pd.DataFrame(peupleraies_merged.drop(columns=peupleraies_merged.geometry.name))
+    attrs = attrs.reset_index(drop=True).iloc[df_stats['position']].reset_index(drop=True)
+    df_stats = pd.concat([attrs, df_stats.drop(columns='position')], axis=1)
+
+    if 'annee_plan' in df_stats.columns:
+        df_stats['annee_plan'] = pd.to_numeric(df_stats['annee_plan'], errors='coerce')
+        df_stats['age_plan'] = df_stats['date'] - df_stats['annee_plan']
+        df_stats = df_stats[df_stats['age_plan'] >= 0].reset_index(drop=True)
+    return apply_schema(df_stats)
+
+
+# Colonnes des parcelles conservées par chaque jointure
+COLONNES_PARCELLE = [
+    'unique_id', 'id_parc', 'annee_plan', 'cultivar', 'cultivar_n',
+    'source', 'PAI_GF_mean', 'VCI_mean', 'CC', 'MOCH', 'ENL',
+    'Z_mean', 'densite', 'biomass_mean', 'lidar_date'
+]
+COLONNES_PIXEL = [
+    'unique_id', 'id_parc', 'annee_plan', 'cultivar', 'cultivar_n',
+    'source', 'densite', 'lidar_date'
+]
+
+# Colonnes d'un lot de pixels avant ajout des métriques LiDAR
+COLONNES_PIXELS = ['x', 'y', 'valeur', 'date', 'tuile', 'pixel_id']
+
+
+def _finaliser_jointure(gdf_joined, cols):
+    """
+    Termine une jointure pixels/parcelles : colonnes, âge de plantation et filtrage.
+
+    Args :
+        gdf_joined (pd.DataFrame) : Résultat de `_jointure_spatiale`.
+        cols (list) : Colonnes des parcelles dont le suffixe '_right' est retiré.
 
+    Returns :
+        pd.DataFrame : données jointes, sans géométrie, avec `age_plan` >= 0.
+    """
     # Renommer les colonnes avec suffixe '_right' si nécessaire
     rename_map = {
         f"{c}_right": c for c in cols if f"{c}_right" in gdf_joined.columns}
@@ -168,6 +1190,7 @@ def jointure_parcelle(df_pixels, peupleraies_merged):
             gdf_joined['annee_plan'], errors='coerce')
         gdf_joined['age_plan'] = gdf_joined['date'] - gdf_joined['annee_plan']
     else:
+        # Colonne vide si les données nécessaires sont absentes
         gdf_joined['age_plan'] = pd.NA
 
     # Filtrer pour supprimer les lignes avec age_plan négatif
@@ -177,50 +1200,39 @@ def jointure_parcelle(df_pixels, peupleraies_merged):
     return pd.DataFrame(gdf_joined.drop(columns=['geometry', 'index_right'], errors='ignore'))
 
 
-def jointure_pixel(df_pixels, peupleraies_merged):
+def jointure_parcelle(df_pixels, peupleraies_merged, label_grid=None):
     """
-    Réalise une jointure spatiale à l'échelle du pixel.
+    Réalise une jointure spatiale à l'échelle des parcelles.
 
     Args :
-        df_pixels (pd.DataFrame) : Données contenant les coordonnées x, y des pixels.
-        peupleraies_merged (gpd.GeoDataFrame) : Données géospatiales des parcelles.
+        df_pixels (pd.DataFrame) : pixels avec coordonnées x et y.
+        peupleraies_merged (gpd.GeoDataFrame) : parcelles avec géométrie.
+        label_grid (tuple, optional) : (labels, transform) issu de `build_parcel_labels`
+            pour ces mêmes parcelles ; remplace la jointure de points par une indexation.
 
     Returns :
-        pd.DataFrame : Données jointes avec colonnes pertinentes pour l'échelle du pixel.
+        pd.DataFrame : données jointes contenant les colonnes pertinentes.
     """
-    # Conversion du DataFrame en GeoDataFrame avec une géométrie basée sur x et y
-    gdf_pixels = gpd.GeoDataFrame(
-        df_pixels,
-        geometry=gpd.points_from_xy(df_pixels['x'], df_pixels['y']),
-        crs=peupleraies_merged.crs
-    )
+    gdf_joined = _jointure_spatiale(df_pixels, peupleraies_merged, label_grid)
+    return _finaliser_jointure(gdf_joined, COLONNES_PARCELLE)
 
-    # Jointure spatiale entre les pixels et les parcelles
-    gdf_joined = sjoin(gdf_pixels, peupleraies_merged,
-                       how='left', predicate='intersects')
 
-    # Liste des colonnes pertinentes pour l'échelle du pixel
-    cols = [
-        'unique_id', 'id_parc', 'annee_plan', 'cultivar', 'cultivar_n',
-        'source', 'densite', 'lidar_date'
-    ]
+def jointure_pixel(df_pixels, peupleraies_merged, label_grid=None):
+    """
+    Réalise une jointure spatiale à l'échelle du pixel.
 
-    # Renommer les colonnes qui contiennent le suffixe '_right'
-    rename_map = {
-        f"{c}_right": c for c in cols if f"{c}_right" in gdf_joined.columns}
-    gdf_joined = gdf_joined.rename(columns=rename_map)
+    Args :
+        df_pixels (pd.DataFrame) : Données contenant les coordonnées x, y des pixels.
+        peupleraies_merged (gpd.GeoDataFrame) : Données géospatiales des parcelles.
+        label_grid (tuple, optional) : (labels, transform) issu de `build_parcel_labels`
+            pour ces mêmes parcelles ; remplace la jointure de points par une indexation.
 
-    # Calculer l'âge de plantation si les colonnes 'date' et 'annee_plan' sont présentes
-    if 'date' in gdf_joined.columns and 'annee_plan' in gdf_joined.columns:
-        gdf_joined['annee_plan'] = pd.to_numeric(
-            gdf_joined['annee_plan'], errors='coerce')
-        gdf_joined['age_plan'] = gdf_joined['date'] - gdf_joined['annee_plan']
-    else:
-        # Colonne vide si les données nécessaires sont absentes
-        gdf_joined['age_plan'] = pd.NA
+    Returns :
+        pd.DataFrame : Données jointes avec colonnes pertinentes pour l'échelle du pixel.
+    """
+    gdf_joined = _jointure_spatiale(df_pixels, peupleraies_merged, label_grid)
+    return _finaliser_jointure(gdf_joined, COLONNES_PIXEL)
 
-    # Filtrer pour supprimer les lignes avec age_plan négatif
-    gdf_joined = gdf_joined[gdf_joined['age_plan'] >= 0]
 
-    # Retourne un DataFrame sans la géométrie ni les colonnes inutiles
-    return pd.DataFrame(gdf_joined.drop(columns=['geometry', 'index_right'], errors='ignore'))
+# Jointure utilisée par chaque échelle de sortie
+JOINTURES = {'parcelle': jointure_parcelle, 'pixel': jointure_pixel}
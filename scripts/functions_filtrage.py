@@ -0,0 +1,148 @@
+# Importation des bibliothèques nécessaires
+import json
+import numpy as np
+import pandas as pd
+from pandas.errors import UndefinedVariableError
+from functions_extract import masque_pixels, pixel_keys_from_xy
+
+# * ======================================= * #
+# * ======================================= * #
+# *   Fonctions pour filtrer les tableaux   * #
+# *     pixel / parcelle par règles         * #
+# * ======================================= * #
+# * ======================================= * #
+
+# Types de règles : exclusions de pixels (tuile, pixel_id) ou de unique_id, exclusion des
+# lignes vérifiant une expression, conservation des seules lignes la vérifiant
+TYPES_REGLES = ('pixels', 'unique_id', 'exclure', 'garder')
+
+
+def _verifier_regle(regle):
+    """
+    Vérifie le type d'une règle et les clés qu'il exige.
+
+    Args :
+        regle (dict) : Règle à vérifier.
+    """
+    type_regle = regle.get('type')
+    if type_regle not in TYPES_REGLES:
+        raise ValueError(f"Type de règle inconnu : {type_regle} (attendu : {TYPES_REGLES})")
+    requises = {'pixels': (), 'unique_id': ('valeurs',),
+                'exclure': ('expression',), 'garder': ('expression',)}[type_regle]
+    manquantes = [cle for cle in requises if cle not in regle]
+    if manquantes:
+        raise ValueError(f"Règle {regle.get('nom', type_regle)} : "
+                         f"clé(s) manquante(s) {manquantes}")
+
+
+def charger_regles(chemin, confidence_rasters=None):
+    """
+    Charge des règles de filtrage depuis un fichier JSON.
+
+    Le fichier contient une liste de règles ou un dictionnaire d'ensembles nommés de règles.
+    Une règle est un dictionnaire avec un 'type' parmi `TYPES_REGLES` et, selon le type :
+    'cles' ([tuile, pixel_id]) ou 'coords' ([x, y]) pour 'pixels', 'valeurs' pour
+    'unique_id', 'expression' (syntaxe `DataFrame.eval`, ex. "grid_CC < 5 & age_plan >= 5")
+    pour 'exclure' et 'garder'. Clés facultatives : 'nom', 'unique_id' (limite une
+    expression à ces parcelles), 'optionnelle' (règle ignorée si une colonne manque) et
+    'active' (False pour désactiver la règle).
+
+    Args :
+        chemin (str) : Chemin du fichier JSON.
+        confidence_rasters (dict, optional) : {tuile : raster de confiance découpé} ; les
+            'coords' des règles 'pixels' sont alors converties une fois en clés entières.
+
+    Returns :
+        list ou dict : Règles, ou {ensemble : règles}, selon la structure du fichier.
+    """
+    with open(chemin, encoding='utf-8') as f:
+        contenu = json.load(f)
+
+    ensembles = contenu if isinstance(contenu, dict) else {None: contenu}
+    for regles in ensembles.values():
+        for regle in regles:
+            _verifier_regle(regle)
+            if regle['type'] == 'pixels':
+                regle['cles'] = [tuple(cle) for cle in regle.get('cles', [])]
+                if regle.get('coords') and confidence_rasters is not None:
+                    coords = [tuple(c) for c in regle.pop('coords')]
+                    regle['cles'] += pixel_keys_from_xy(coords, confidence_rasters)
+    return contenu
+
+
+def _masque_regle(df, regle):
+    """
+    Calcule les lignes retirées par une règle, sur tout le tableau.
+
+    Args :
+        df (pd.DataFrame) : Tableau à filtrer.
+        regle (dict) : Règle vérifiée par `_verifier_regle`.
+
+    Returns :
+        np.ndarray ou None : Masque booléen des lignes retirées, None si la règle est
+        optionnelle et qu'une colonne manque.
+    """
+    type_regle = regle['type']
+    if type_regle == 'pixels':
+        if regle.get('coords'):
+            raise ValueError(f"Règle {regle.get('nom', type_regle)} : coordonnées non converties "
+                             f"(passer `confidence_rasters` à `charger_regles`)")
+        manquantes = [col for col in ('tuile', 'pixel_id') if col not in df.columns]
+        if manquantes:
+            # Tableaux antérieurs à l'index de grille (anciens CSV)
+            raise ValueError(f"Règle {regle.get('nom', type_regle)} : colonne(s) {manquantes} "
+                             f"absente(s) du tableau ; relancer le notebook 3 pour les produire")
+        return masque_pixels(df, [tuple(cle) for cle in regle.get('cles', [])])
+    if type_regle == 'unique_id':
+        return df['unique_id'].isin(regle['valeurs']).to_numpy(dtype=bool)
+
+    try:
+        condition = pd.Series(df.eval(regle['expression']), index=df.index)
+    except UndefinedVariableError:
+        if regle.get('optionnelle', False):
+            return None
+        raise
+    # Comme un filtre booléen pandas, une valeur manquante ne garde pas la ligne
+    garder = condition if type_regle == 'garder' else ~condition
+    retire = ~garder.fillna(False).to_numpy(dtype=bool)
+
+    if 'unique_id' in regle:
+        retire = retire & df['unique_id'].isin(regle['unique_id']).to_numpy(dtype=bool)
+    return retire
+
+
+def filtrer_tableau(df, regles):
+    """
+    Applique une liste de règles de filtrage, chacune évaluée en un masque vectoriel.
+
+    Chaque règle est évaluée une fois sur tout le tableau ; les lignes retirées sont
+    attribuées à la première règle qui les exclut, dans l'ordre de la liste. Le résultat
+    est identique à l'application successive des filtres.
+
+    Args :
+        df (pd.DataFrame) : Tableau pixel ou parcelle.
+        regles (list) : Règles (voir `charger_regles`).
+
+    Returns :
+        tuple : (tableau filtré, rapport) ; le rapport (pd.DataFrame) donne pour chaque
+        règle son nom, son type, si elle a été appliquée et le nombre de lignes retirées.
+    """
+    restant = np.ones(len(df), dtype=bool)
+    lignes = []
+    for i, regle in enumerate(regles):
+        _verifier_regle(regle)
+        nom = regle.get('nom', f"regle_{i}")
+
+        retire = _masque_regle(df, regle) if regle.get('active', True) else None
+        if retire is None:
+            lignes.append({'regle': nom, 'type': regle['type'], 'appliquee': False,
+                           'lignes_retirees': 0})
+            continue
+
+        retire = retire & restant
+        restant &= ~retire
+        lignes.append({'regle': nom, 'type': regle['type'], 'appliquee': True,
+                       'lignes_retirees': int(retire.sum())})
+
+    rapport = pd.DataFrame(lignes, columns=['regle', 'type', 'appliquee', 'lignes_retirees'])
+    return df[restant], rapport
@@ -1,7 +1,15 @@
 # Importation des bibliothèques nécessaires
+import io
+import os
 import re
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stdout
+import numpy as np
 import pandas as pd
 import geopandas as gpd
+import shapely
 
 
 # * ======================================= * #
@@ -10,6 +18,99 @@ import geopandas as gpd
 # * ======================================= * #
 # * ======================================= * #
 
+# Motifs compilés une seule fois pour la validation des cultivars
+MOTS_EXCLUS = re.compile(
+    r'\b(melange|essai|essais|futaie melangee|divers|et|noyer hybride|noyer commun|robinier|cemagref|cèdre|vesten dellinois|noyer/robinier|A 4 A )\b',
+    re.IGNORECASE)
+FORMAT_ESSAI = re.compile(r'\d{3,4}-\d{1,2}')
+SEPARATEUR_CULTIVARS = re.compile(r'\s*-\s*')
+
+
+# Politiques de traitement des géométries en plusieurs parties (voir `normaliser_geometries`)
+POLITIQUES_MULTI = ('plus_grande', 'exploser', 'premiere')
+
+
+def _parties_polygonales(geoms):
+    """
+    Décompose des géométries en parties simples et ne garde que les polygones non vides.
+
+    Args:
+        geoms (np.ndarray): Géométries shapely (collections et multi-parties acceptées).
+
+    Returns:
+        tuple: (parties, index) : polygones et position de leur géométrie d'origine.
+    """
+    parties = geoms
+    index = np.arange(len(geoms))
+    # Les collections issues de make_valid peuvent contenir des multi-polygones
+    while True:
+        composees = np.isin(shapely.get_type_id(parties), (4, 5, 6, 7))
+        if not composees.any():
+            break
+        sous_parties, position = shapely.get_parts(parties[composees], return_index=True)
+        index = np.concatenate([index[~composees], index[composees][position]])
+        parties = np.concatenate([parties[~composees], sous_parties])
+        ordre = np.argsort(index, kind='stable')
+        parties, index = parties[ordre], index[ordre]
+
+    polygones = (shapely.get_type_id(parties) == 3) & ~shapely.is_empty(parties)
+    return parties[polygones], index[polygones]
+
+
+def normaliser_geometries(gdf, politique='plus_grande'):
+    """
+    Répare les géométries et ramène chaque entité à des polygones simples, en bloc.
+
+    Les géométries invalides passent par `make_valid`, puis seules les parties polygonales
+    sont conservées (les lignes ou points issus de la réparation sont écartés). Les
+    entités en plusieurs parties sont traitées selon la politique :
+    'plus_grande' garde la partie de plus grande surface, 'exploser' produit une ligne par
+    partie (attributs répétés) et 'premiere' garde la première partie, comme l'ancien
+    `geom.geoms[0]`. Les entités sans surface sont retirées.
+
+    Args:
+        gdf (GeoDataFrame): Entités à normaliser.
+        politique (str, optional): 'plus_grande', 'exploser' ou 'premiere' (défaut : 'plus_grande').
+
+    Returns:
+        tuple: (GeoDataFrame normalisé, rapport) ; le rapport (dict) donne le nombre de
+        géométries réparées, en plusieurs parties et retirées, et la surface perdue.
+    """
+    if politique not in POLITIQUES_MULTI:
+        raise ValueError(f"Politique inconnue : {politique} (attendu : {POLITIQUES_MULTI})")
+
+    geoms = np.asarray(gdf.geometry.values, dtype=object)
+    invalides = ~shapely.is_valid(geoms) & ~shapely.is_missing(geoms)
+    if invalides.any():
+        geoms = geoms.copy()
+        geoms[invalides] = shapely.make_valid(geoms[invalides])
+    surface_initiale = float(np.nansum(shapely.area(geoms)))
+
+    parties, index = _parties_polygonales(geoms)
+    nb_parties = np.bincount(index, minlength=len(geoms))
+
+    if politique != 'exploser':
+        # Une partie par entité : la plus grande (ex æquo : la première) ou la première
+        if politique == 'plus_grande':
+            ordre = np.lexsort((-shapely.area(parties), index))
+            parties, index = parties[ordre], index[ordre]
+        premieres = np.r_[True, index[1:] != index[:-1]] if len(index) else np.zeros(0, bool)
+        parties, index = parties[premieres], index[premieres]
+
+    resultat = gdf.iloc[index].copy()
+    resultat[gdf.geometry.name] = gpd.GeoSeries(parties, crs=gdf.crs).values
+    surface_finale = float(shapely.area(parties).sum())
+
+    rapport = {
+        'reparees': int(invalides.sum()),
+        'multi_parties': int((nb_parties > 1).sum()),
+        'retirees': int((nb_parties == 0).sum()),
+        'surface_initiale': surface_initiale,
+        'surface_perdue': surface_initiale - surface_finale,
+    }
+    return resultat, rapport
+
+
 # Fonction pour vérifier si une valeur dans la colonne 'cultivar' contient un seul cultivar
 def seul_cultivar(valeur):
     """
@@ -30,52 +131,150 @@ def seul_cultivar(valeur):
     if ',' in valeur:
         return False
     # Si la valeur contient certains mots spécifiques ou combinaisons, retourne False
-    if re.search(r'\b(melange|essai|essais|futaie melangee|divers|et|noyer hybride|noyer commun|robinier|cemagref|cèdre|vesten dellinois|noyer/robinier|A 4 A )\b', valeur, re.IGNORECASE):
+    if MOTS_EXCLUS.search(valeur):
         return False
     # Si la valeur correspond à un format d'essai (par ex. 1000-1), retourne False
-    if re.search(r'\d{3,4}-\d{1,2}', valeur):
+    if FORMAT_ESSAI.search(valeur):
         return False
     # Divise la chaîne de caractères selon des tirets ou espaces et vérifie s'il y a un seul cultivar
-    cultivars = re.split(r'\s*-\s*', valeur.strip().lower())
+    cultivars = SEPARATEUR_CULTIVARS.split(valeur.strip().lower())
     return len(set(cultivars)) == 1
 
 
-def corriger_cultivar(nom):
+def masque_seul_cultivar(serie):
+    """
+    Applique `seul_cultivar` à toute une colonne en n'évaluant qu'une fois chaque valeur distincte.
+
+    Les couches d'inventaire répètent peu de libellés de cultivar sur des centaines de milliers
+    de parcelles : le test est fait sur les valeurs distinctes puis reporté sur les lignes par
+    leurs codes, ce qui donne exactement le résultat de `serie.apply(seul_cultivar)`.
+
+    Args:
+        serie (pd.Series): Colonne 'cultivar'.
+
+    Returns:
+        pd.Series: Masque booléen aligné sur `serie`.
+    """
+    codes, uniques = pd.factorize(serie)
+    valides = np.array([seul_cultivar(valeur) for valeur in uniques] + [False], dtype=bool)
+    # Les valeurs manquantes (code -1) prennent le dernier élément : False
+    return pd.Series(valides[codes], index=serie.index)
+
+
+# Corrections des noms de cultivars, indexées par le nom en minuscules
+CORRECTIONS_CULTIVARS = {
+    'A4a': 'A4A',
+    'i 2014': 'i214',
+    'i 214': 'i214',
+    'i214': 'i214',
+    'i45/51': 'i45/51',
+    'i 45/51': 'i45/51',
+    'ameramo': 'aleramo',
+    'aleramo': 'aleramo',
+    'dvina': 'diva',
+    'diva': 'diva',
+    'raspage': 'raspalje',
+    'raspalje': 'raspalje',
+    'hoogorst': 'hoogvorst',
+    'hoogvorst': 'hoogvorst'
+}
+
+
+def charger_corrections(chemin):
+    """
+    Charge une table de corrections de cultivars depuis un fichier CSV.
+
+    Le fichier contient les colonnes 'nom' (comparé au nom brut mis en minuscules) et
+    'correction'. Les valeurs sont lues telles quelles, sans conversion des 'nan'.
+
+    Args:
+        chemin (str): Chemin du fichier CSV.
+
+    Returns:
+        dict: Corrections {nom: correction}, utilisables par `corriger_cultivar`.
+    """
+    table = pd.read_csv(chemin, dtype=str, keep_default_na=False)
+    return dict(zip(table['nom'], table['correction']))
+
+
+def _table_corrections(corrections):
+    """Renvoie le dictionnaire de corrections : défaut, chemin CSV ou dictionnaire fourni."""
+    if corrections is None:
+        return CORRECTIONS_CULTIVARS
+    if isinstance(corrections, str):
+        return charger_corrections(corrections)
+    return corrections
+
+
+def corriger_cultivar(nom, corrections=None):
     """
     Corrige les noms de cultivars en appliquant des corrections prédéfinies.
 
     Args:
         nom (str): Nom du cultivar à corriger.
+        corrections (dict, optional): Table {nom en minuscules: correction}
+            (défaut : CORRECTIONS_CULTIVARS).
 
     Returns:
         str: Nom corrigé si une correspondance existe, sinon la valeur d'origine.
     """
-
-    corrections = {
-        'A4a': 'A4A',
-        'i 2014': 'i214',
-        'i 214': 'i214',
-        'i214': 'i214',
-        'i45/51': 'i45/51',
-        'i 45/51': 'i45/51',
-        'ameramo': 'aleramo',
-        'aleramo': 'aleramo',
-        'dvina': 'diva',
-        'diva': 'diva',
-        'raspage': 'raspalje',
-        'raspalje': 'raspalje',
-        'hoogorst': 'hoogvorst',
-        'hoogvorst': 'hoogvorst'
-    }
+    if corrections is None:
+        corrections = CORRECTIONS_CULTIVARS
     # Vérifie si 'nom' est une chaîne de caractères
     if isinstance(nom, str):
         return corrections.get(nom.lower(), nom)
     return nom  # Retourner la valeur d'origine si ce n'est pas une chaîne
 
+
+def capitaliser_cultivar(nom):
+    """
+    Capitalise la première lettre de chaque mot d'un nom de cultivar.
+
+    Args:
+        nom (str): Nom du cultivar.
+
+    Returns:
+        str: Nom capitalisé, ou la valeur d'origine si ce n'est pas une chaîne.
+    """
+    if isinstance(nom, str):
+        return ' '.join(mot.capitalize() for mot in nom.split())
+    return nom
+
+
+def normaliser_cultivars(serie, corrections=None, capitaliser=False):
+    """
+    Corrige (et capitalise si demandé) une colonne de cultivars, une fois par valeur distincte.
+
+    Chaque nom brut distinct passe une seule fois par `corriger_cultivar` puis
+    `capitaliser_cultivar` ; le résultat est reporté sur les lignes par les codes d'une
+    colonne catégorielle. Le coût dépend du nombre de cultivars, pas du nombre de parcelles.
+
+    Args:
+        serie (pd.Series): Noms bruts des cultivars.
+        corrections (dict ou str, optional): Table de corrections ou chemin d'un CSV lu par
+            `charger_corrections` (défaut : CORRECTIONS_CULTIVARS).
+        capitaliser (bool, optional): Capitalise chaque mot du nom corrigé (défaut : False).
+
+    Returns:
+        pd.Series: Noms normalisés, de type 'category', alignés sur `serie`.
+    """
+    corrections = _table_corrections(corrections)
+    codes, uniques = pd.factorize(serie)
+    noms = [corriger_cultivar(nom, corrections) for nom in uniques]
+    if capitaliser:
+        noms = [capitaliser_cultivar(nom) for nom in noms]
+
+    # Plusieurs noms bruts peuvent donner le même nom normalisé : catégories dédoublonnées
+    codes_noms, categories = pd.factorize(pd.Series(noms, dtype=object))
+    codes = np.where(codes >= 0, codes_noms[codes], -1)
+    return pd.Series(pd.Categorical.from_codes(codes, categories=categories),
+                     index=serie.index)
+
 # Nettoyage final du shapefile**
 
 
-def nettoyer_gpkg(df, colonnes_a_conserver, dictionnaire_noms, couche_nom, echelle):
+def nettoyer_gpkg(df, colonnes_a_conserver, dictionnaire_noms, couche_nom, echelle,
+                  corrections=None, politique_multi='plus_grande'):
     """
     Nettoie un shapefile en sélectionnant certaines colonnes, en les renommant,
     en gérant les colonnes spécifiques (densite) et en s'assurant que la structure finale est cohérente.
@@ -86,6 +285,11 @@ def nettoyer_gpkg(df, colonnes_a_conserver, dictionnaire_noms, couche_nom, echel
         dictionnaire_noms (dict): Dictionnaire pour renommer les colonnes.
         couche_nom (str): Nom de la couche pour la logique spécifique.
         echelle (str): 'parcelle' ou 'pixel' pour déterminer les colonnes finales.
+        corrections (dict ou str, optional): Table de corrections des cultivars ou chemin
+            d'un CSV (défaut : CORRECTIONS_CULTIVARS).
+        politique_multi (str, optional): Traitement des MultiPolygon par
+            `normaliser_geometries` : 'plus_grande' (défaut), 'exploser' (une ligne par
+            partie, même id_parc) ou 'premiere' (ancien comportement).
 
     Returns:
         GeoDataFrame: Données nettoyées et cohérentes.
@@ -138,12 +342,16 @@ def nettoyer_gpkg(df, colonnes_a_conserver, dictionnaire_noms, couche_nom, echel
             df = df.drop(columns=['d_essenc_2'])
 
     # 6. Corriger les noms des cultivars pour uniformiser les données
-    df['cultivar_n'] = df['cultivar'].apply(corriger_cultivar)
+    df['cultivar_n'] = normaliser_cultivars(df['cultivar'], corrections)
 
-    # 7. Convertir les MultiPolygon en Polygon si nécessaire
-    df["geometry"] = df["geometry"].apply(
-        lambda geom: geom.geoms[0] if geom.geom_type == "MultiPolygon" else geom
-    )
+    # 7. Réparer les géométries et ramener les MultiPolygon à des Polygon
+    df, rapport = normaliser_geometries(df, politique_multi)
+    surface = rapport['surface_initiale']
+    part_perdue = rapport['surface_perdue'] / surface if surface else 0.0
+    print(
+        f"Département {couche_nom} : Géométries réparées : {rapport['reparees']}, "
+        f"multi-parties : {rapport['multi_parties']}, sans surface : {rapport['retirees']}, "
+        f"surface perdue : {rapport['surface_perdue']:.0f} m² ({part_perdue:.2%})")
 
     # 8. Définir les colonnes finales en fonction de l'échelle
     if echelle == 'parcelle':
@@ -165,7 +373,7 @@ def nettoyer_gpkg(df, colonnes_a_conserver, dictionnaire_noms, couche_nom, echel
 
     # 10. Filtrer les parcelles pour ne garder que celles avec un seul cultivar
     nb_avant_filtrage = len(df)
-    df = df[df['cultivar'].apply(seul_cultivar)]
+    df = df[masque_seul_cultivar(df['cultivar'])]
     nb_apres_filtrage = len(df)
 
     print(
@@ -214,8 +422,159 @@ def finaliser_gpkg(df, source, echelle):
 
     # Capitaliser chaque mot de la chaîne 'cultivar_n' si elle existe
     if 'cultivar_n' in df.columns:
-        df['cultivar_n'] = df['cultivar_n'].apply(lambda nom: ' '.join(
-            mot.capitalize() for mot in nom.split()) if isinstance(nom, str) else nom)
+        # Les corrections ont déjà été appliquées par `nettoyer_gpkg`
+        df['cultivar_n'] = normaliser_cultivars(df['cultivar_n'], corrections={},
+                                                capitaliser=True)
 
     # Retourner les colonnes dans l'ordre spécifié
     return df[colonnes_finales]
+
+
+# * ======================================= * #
+# * ======================================= * #
+#   Nettoyage parallèle des départements    * #
+# * ======================================= * #
+# * ======================================= * #
+
+def _nettoyer_departement_job(couche_nom, config, echelles, crs_cible, corrections,
+                              politique_multi):
+    """
+    Lit une couche départementale, la reprojette et la nettoie à chaque échelle.
+
+    Args:
+        couche_nom (str): Nom du département (ex. 'dep47').
+        config (dict): 'chemin', 'couche' (None pour un shapefile), 'colonnes' et 'noms'.
+        echelles (list): Échelles à produire ('parcelle', 'pixel').
+        crs_cible (str): Système de coordonnées de sortie.
+        corrections (dict ou str): Table de corrections des cultivars.
+        politique_multi (str): Traitement des MultiPolygon (voir `normaliser_geometries`).
+
+    Returns:
+        dict: 'couche', 'tables' ({échelle: GeoDataFrame}), 'log' (messages du nettoyage),
+        'duration' (s) et 'error' (None si succès).
+    """
+    record = {'couche': couche_nom, 'tables': {}, 'log': '', 'duration': None, 'error': None}
+    debut = time.perf_counter()
+    log = io.StringIO()
+    try:
+        # Les messages de nettoyage sont rendus au processus principal avec le résultat
+        with redirect_stdout(log):
+            # Lecture en colonnes Arrow, puis une seule reprojection pour toutes les échelles
+            brut = gpd.read_file(config['chemin'], layer=config.get('couche'), use_arrow=True)
+            data_reproj = brut.to_crs(crs_cible)
+            del brut
+            for echelle in echelles:
+                dep_clean = nettoyer_gpkg(data_reproj, config['colonnes'], config['noms'],
+                                          couche_nom, echelle, corrections, politique_multi)
+                record['tables'][echelle] = finaliser_gpkg(dep_clean, couche_nom, echelle)
+    except Exception:
+        record['error'] = traceback.format_exc()
+    record['log'] = log.getvalue()
+    record['duration'] = time.perf_counter() - debut
+    return record
+
+
+def _types_fusion(tables):
+    """
+    Détermine les types des colonnes de `pd.concat(tables)` sans concaténer les tables.
+
+    `pd.concat` tient compte des colonnes entièrement vides : chaque table est réduite à une
+    ligne qui porte, pour chaque colonne, une valeur non manquante s'il en existe une.
+
+    Args:
+        tables (list): GeoDataFrames de mêmes colonnes.
+
+    Returns:
+        dict: {colonne: dtype} des colonnes non géométriques.
+    """
+    representants = []
+    for table in tables:
+        if table.empty:
+            representants.append(pd.DataFrame(table.drop(columns='geometry')))
+            continue
+        ligne = {}
+        for col in table.columns.drop('geometry'):
+            remplie = table[col].notna().to_numpy()
+            pos = int(remplie.argmax()) if remplie.any() else 0
+            ligne[col] = table[col].iloc[[pos]].reset_index(drop=True)
+        representants.append(pd.DataFrame(ligne))
+    return pd.concat(representants, ignore_index=True).dtypes.to_dict()
+
+
+def nettoyer_departements(dep_configs, gpkgs, crs_cible, corrections=None,
+                          politique_multi='plus_grande', max_workers=None, overwrite=True):
+    """
+    Lit, reprojette et nettoie les couches départementales en parallèle puis écrit les GeoPackages.
+
+    Chaque département est traité par un worker qui lit sa couche une seule fois (lecture
+    Arrow), la reprojette et produit les tables de toutes les échelles. Le processus
+    principal écrit les couches `<département>_<échelle>_clean` dans l'ordre de
+    `dep_configs` au fur et à mesure des résultats, puis la couche
+    `peupleraies_merged_<échelle>` par ajouts successifs, sans table concaténée en mémoire.
+    Les types de la couche fusionnée sont ceux qu'aurait donnés `pd.concat`. La durée du
+    nettoyage est ainsi celle du département le plus long, plus l'écriture.
+
+    Args:
+        dep_configs (dict): {département: {'chemin', 'couche', 'colonnes', 'noms'}}, 'couche'
+            valant None pour un shapefile.
+        gpkgs (dict): {échelle: chemin du GeoPackage de sortie}.
+        crs_cible (str): Système de coordonnées de sortie (ex. 'EPSG:2154').
+        corrections (dict ou str, optional): Table de corrections des cultivars ou chemin d'un
+            CSV (défaut : CORRECTIONS_CULTIVARS).
+        politique_multi (str, optional): Traitement des MultiPolygon (voir
+            `normaliser_geometries`, défaut : 'plus_grande').
+        max_workers (int, optional): Nombre de processus (défaut : nombre de cœurs).
+        overwrite (bool, optional): Supprime les GeoPackages existants (défaut : True).
+
+    Returns:
+        list: Un dictionnaire par département ('couche', 'rows' par échelle, 'duration',
+        'error'), dans l'ordre de `dep_configs`.
+    """
+    for gpkg_path in gpkgs.values():
+        if overwrite and os.path.exists(gpkg_path):
+            os.remove(gpkg_path)
+            print(f"Fichier supprimé: {gpkg_path}")
+        os.makedirs(os.path.dirname(os.path.abspath(gpkg_path)), exist_ok=True)
+
+    couches = list(dep_configs)
+    resultats = {}
+    prochain = 0
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(_nettoyer_departement_job, couche_nom, config, list(gpkgs),
+                               crs_cible, corrections, politique_multi)
+                   for couche_nom, config in dep_configs.items()]
+
+        for future in as_completed(futures):
+            record = future.result()
+            resultats[record['couche']] = record
+
+            # Écriture des couches départementales dans l'ordre de la configuration
+            while prochain < len(couches) and couches[prochain] in resultats:
+                record = resultats[couches[prochain]]
+                print(record['log'], end='')
+                for echelle, table in record['tables'].items():
+                    table.to_file(gpkgs[echelle], layer=f"{record['couche']}_{echelle}_clean",
+                                  driver="GPKG")
+                prochain += 1
+
+    records = [resultats[couche_nom] for couche_nom in couches]
+
+    # Couche fusionnée : une table par département ajoutée à la suite, aux types de pd.concat
+    for echelle, gpkg_path in gpkgs.items():
+        tables = [record['tables'][echelle] for record in records if record['error'] is None]
+        if not tables:
+            continue
+        types = _types_fusion(tables)
+        for i, table in enumerate(tables):
+            table = gpd.GeoDataFrame(table.astype(types), crs=crs_cible)
+            table.to_file(gpkg_path, layer=f"peupleraies_merged_{echelle}", driver="GPKG",
+                          mode='w' if i == 0 else 'a')
+
+    for record in records:
+        record['rows'] = {echelle: len(table) for echelle, table in record.pop('tables').items()}
+        statut = 'OK' if record['error'] is None else 'ERREUR'
+        lignes = ', '.join(f"{echelle} {n} parcelles" for echelle, n in record['rows'].items())
+        print(f"{record['couche']} : {statut}, {lignes} ({record['duration']:.1f} s)")
+        if record['error'] is not None:
+            print(record['error'])
+    return records
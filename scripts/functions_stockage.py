@@ -0,0 +1,400 @@
+# Importation des bibliothèques nécessaires
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# * ======================================= * #
+# * ======================================= * #
+# *    Fonctions de stockage des tableaux   * #
+# *     pixel / parcelle en Parquet         * #
+# * ======================================= * #
+# * ======================================= * #
+
+# Types Arrow des colonnes connues ; les autres colonnes gardent le type inféré
+COLUMN_TYPES = {
+    'x': pa.float64(),
+    'y': pa.float64(),
+    'valeur': pa.uint8(),
+    'date': pa.int16(),
+    'tuile': pa.string(),
+    'pixel_id': pa.int64(),
+    'row': pa.int32(),
+    'col': pa.int32(),
+    'grid_CC': pa.float32(),
+    'grid_ENL': pa.float32(),
+    'grid_MOCH': pa.float32(),
+    'grid_PAI': pa.float32(),
+    'grid_VCI': pa.float32(),
+    'unique_id': pa.string(),
+    'id_parc': pa.string(),
+    'annee_plan': pa.int16(),
+    'cultivar_n': pa.dictionary(pa.int16(), pa.string()),
+    'source': pa.dictionary(pa.int8(), pa.string()),
+    'lidar_date': pa.int16(),
+    'age_plan': pa.int16(),
+}
+
+# Types pandas compacts des tableaux pixel / parcelle (`apply_schema`)
+SCHEMA = {
+    'x': 'float64',
+    'y': 'float64',
+    'valeur': 'uint8',         # Probabilité d'appartenance (0-100)
+    'date': 'int16',
+    'tuile': 'category',
+    'pixel_id': 'int64',
+    'row': 'int32',
+    'col': 'int32',
+    'grid_CC': 'float32',
+    'grid_ENL': 'float32',
+    'grid_MOCH': 'float32',
+    'grid_PAI': 'float32',
+    'grid_VCI': 'float32',
+    'unique_id': 'category',
+    'id_parc': 'category',
+    'annee_plan': 'int16',
+    'cultivar': 'category',
+    'cultivar_n': 'category',
+    'source': 'category',
+    'lidar_date': 'int16',
+    'age_plan': 'int16',
+}
+
+# Colonnes de partitionnement par défaut (répertoires tuile=.../date=...)
+PARTITION_COLS = ('tuile', 'date')
+
+# Clé des métadonnées Parquet conservant l'ordre d'origine des colonnes
+_ORDER_KEY = b'colonnes'
+
+
+def _verifier_plage(series, col, dtype):
+    """
+    Vérifie que les valeurs d'une colonne tiennent dans le type entier visé.
+
+    Args :
+        series (pd.Series) : Valeurs numériques (les manquantes sont ignorées).
+        col (str) : Nom de la colonne, repris dans le message d'erreur.
+        dtype : Type entier visé (ex. 'uint8').
+    """
+    info = np.iinfo(dtype)
+    vmin, vmax = series.min(), series.max()
+    if len(series) and (vmin < info.min or vmax > info.max):
+        raise ValueError(f"Colonne {col} : valeurs hors de la plage de {np.dtype(dtype)} "
+                         f"({info.min} à {info.max}) : min {vmin}, max {vmax}")
+
+
+def _to_arrow(df):
+    """
+    Convertit un DataFrame en table Arrow typée selon `COLUMN_TYPES`.
+
+    Args :
+        df (pd.DataFrame) : Tableau pixel ou parcelle.
+
+    Returns :
+        pa.Table : Table typée, avec l'ordre des colonnes dans les métadonnées.
+    """
+    df = df.copy()
+    # id_parc est lu en texte par les notebooks ; les identifiants numériques (float64 après
+    # une jointure gauche sans correspondance) sont écrits en entiers : 12.0 -> '12'
+    if 'id_parc' in df.columns and not pd.api.types.is_string_dtype(df['id_parc']):
+        ids = df['id_parc']
+        if isinstance(ids.dtype, pd.CategoricalDtype):
+            ids = ids.astype(ids.cat.categories.dtype)
+        if pd.api.types.is_numeric_dtype(ids):
+            ids = pd.to_numeric(ids).astype('Int64')
+        df['id_parc'] = ids.astype('string')
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    fields = []
+    for field in table.schema:
+        target = COLUMN_TYPES.get(field.name)
+        if target is not None and pa.types.is_integer(target):
+            # Erreur explicite plutôt qu'un ArrowInvalid au milieu de l'écriture
+            _verifier_plage(pd.to_numeric(df[field.name], errors='coerce'), field.name,
+                            target.to_pandas_dtype())
+        fields.append(pa.field(field.name, target) if target is not None else field)
+    table = table.cast(pa.schema(fields))
+
+    metadata = dict(table.schema.metadata or {})
+    metadata[_ORDER_KEY] = json.dumps(list(df.columns)).encode()
+    return table.replace_schema_metadata(metadata)
+
+
+def apply_schema(df):
+    """
+    Convertit les colonnes connues d'un tableau pixel ou parcelle vers les types de `SCHEMA`.
+
+    Les textes deviennent des catégories, la confiance uint8, les années et âges int16 et
+    les métriques float32. Une colonne entière contenant des valeurs manquantes passe en
+    float32 (NaN conservés) ; une colonne texte est d'abord convertie en nombres, et garde
+    son type si une valeur n'est pas numérique. Une valeur hors de la plage du type entier
+    visé (ex. `valeur` = 300 pour uint8) lève une ValueError nommant la colonne.
+
+    Args :
+        df (pd.DataFrame) : Tableau à convertir.
+
+    Returns :
+        pd.DataFrame : Nouveau tableau typé (les données non converties sont partagées).
+    """
+    df = df.copy(deep=False)
+    for col, dtype in SCHEMA.items():
+        if col not in df.columns or df[col].dtype == dtype:
+            continue
+        series = df[col]
+        if dtype == 'category':
+            df[col] = series.astype('category')
+        elif np.issubdtype(np.dtype(dtype), np.integer):
+            if not pd.api.types.is_numeric_dtype(series):
+                # Textes numériques (ex. lidar_date lu depuis le GeoPackage) ; sinon type conservé
+                nombres = pd.to_numeric(series, errors='coerce')
+                if nombres.isna().sum() > series.isna().sum():
+                    continue
+                series = nombres
+            _verifier_plage(series, col, dtype)
+            if series.isna().any():
+                df[col] = series.astype('float32')
+                continue
+            df[col] = series.astype(dtype)
+        else:
+            df[col] = series.astype(dtype)
+    return df
+
+
+def _partitioning(partition_cols):
+    """
+    Construit le schéma de partitionnement Hive des colonnes données.
+
+    Args :
+        partition_cols (list) : Colonnes de partitionnement.
+
+    Returns :
+        ds.Partitioning : Partitionnement typé (tuile texte, date int16).
+    """
+    return ds.partitioning(
+        pa.schema([(col, COLUMN_TYPES.get(col, pa.string())) for col in partition_cols]),
+        flavor='hive')
+
+
+def _filter_expression(filters):
+    """
+    Convertit des filtres en expression Arrow.
+
+    Args :
+        filters (list, ds.Expression ou None) : Expression Arrow, ou liste de tuples
+            (colonne, opérateur, valeur) combinés par ET, ou liste de listes (OU de ET),
+            comme pour `pd.read_parquet`.
+
+    Returns :
+        ds.Expression ou None : Expression à pousser au lecteur Parquet.
+    """
+    if filters is None or isinstance(filters, ds.Expression):
+        return filters
+    return pq.filters_to_expression(filters)
+
+
+def write_table(df, dataset_path, partition_cols=PARTITION_COLS, overwrite=True):
+    """
+    Écrit un tableau pixel ou parcelle en jeu de données Parquet partitionné.
+
+    Args :
+        df (pd.DataFrame) : Tableau à écrire.
+        dataset_path (str) : Répertoire du jeu de données (ex. '.../tableaux/df_pixel').
+        partition_cols (tuple) : Colonnes de partitionnement présentes dans `df`
+            (défaut : ('tuile', 'date')).
+        overwrite (bool) : Supprime le jeu de données existant avant l'écriture ; sinon,
+            seules les partitions écrites sont remplacées (défaut : True).
+
+    Returns :
+        str : Chemin du jeu de données.
+    """
+    if overwrite and os.path.isdir(dataset_path):
+        shutil.rmtree(dataset_path)
+    os.makedirs(dataset_path, exist_ok=True)
+
+    table = _to_arrow(df)
+    partition_cols = [col for col in partition_cols if col in table.column_names]
+    ds.write_dataset(
+        table, dataset_path, format='parquet',
+        partitioning=_partitioning(partition_cols) if partition_cols else None,
+        basename_template='part-{i}.parquet',
+        existing_data_behavior='delete_matching',
+        file_options=ds.ParquetFileFormat().make_write_options(compression='zstd'))
+    return dataset_path
+
+
+def append_table(df, dataset_path, basename, partition_cols=PARTITION_COLS):
+    """
+    Ajoute un lot de lignes à un jeu de données Parquet sans toucher aux fichiers existants.
+
+    Args :
+        df (pd.DataFrame) : Lot à ajouter.
+        dataset_path (str) : Répertoire du jeu de données.
+        basename (str) : Nom de base des fichiers du lot, unique dans le jeu de données ;
+            un lot réécrit avec le même nom remplace le précédent.
+        partition_cols (tuple) : Colonnes de partitionnement (défaut : ('tuile', 'date')).
+
+    Returns :
+        str : Chemin du jeu de données.
+    """
+    os.makedirs(dataset_path, exist_ok=True)
+    table = _to_arrow(df)
+    partition_cols = [col for col in partition_cols if col in table.column_names]
+    ds.write_dataset(
+        table, dataset_path, format='parquet',
+        partitioning=_partitioning(partition_cols) if partition_cols else None,
+        basename_template=f'{basename}-{{i}}.parquet',
+        existing_data_behavior='overwrite_or_ignore',
+        file_options=ds.ParquetFileFormat().make_write_options(compression='zstd'))
+    return dataset_path
+
+
+def _partition_cols(dataset_path):
+    """
+    Retrouve les colonnes de partitionnement d'un jeu de données à partir des répertoires.
+
+    Args :
+        dataset_path (str) : Répertoire du jeu de données.
+
+    Returns :
+        list : Colonnes de partitionnement, de la plus haute à la plus basse.
+    """
+    cols, current = [], dataset_path
+    while True:
+        subdirs = sorted(name for name in os.listdir(current)
+                         if '=' in name and os.path.isdir(os.path.join(current, name)))
+        if not subdirs:
+            return cols
+        cols.append(subdirs[0].split('=', 1)[0])
+        current = os.path.join(current, subdirs[0])
+
+
+def read_table(dataset_path, columns=None, filters=None, categorical=False):
+    """
+    Lit un jeu de données Parquet partitionné, en ne chargeant que le nécessaire.
+
+    Les colonnes non demandées ne sont pas lues et les filtres sont poussés au lecteur :
+    les partitions tuile/date exclues ne sont pas ouvertes, et les groupes de lignes
+    exclus par leurs statistiques sont ignorés.
+
+    Args :
+        dataset_path (str) : Répertoire du jeu de données.
+        columns (list) : Colonnes à lire (défaut : toutes, dans l'ordre d'origine).
+        filters (list ou ds.Expression) : Filtres, ex. [('tuile', '==', 'T30TYP'),
+            ('date', '>=', 2020)].
+        categorical (bool) : Restitue les colonnes encodées par dictionnaire (cultivar_n,
+            source) en catégories pandas plutôt qu'en texte (défaut : False).
+
+    Returns :
+        pd.DataFrame : Tableau lu, lignes regroupées par partition.
+    """
+    partition_cols = _partition_cols(dataset_path)
+
+    # Fichiers dans l'ordre des chemins : ordre des lignes indépendant de l'écriture
+    files = sorted(os.path.join(root, name)
+                   for root, _, names in os.walk(dataset_path)
+                   for name in names if name.endswith('.parquet'))
+    dataset = ds.dataset(files, format='parquet', partition_base_dir=dataset_path,
+                         partitioning=_partitioning(partition_cols) if partition_cols else None)
+
+    # Ordre d'origine des colonnes, partitions comprises
+    metadata = dataset.schema.metadata or {}
+    order = json.loads(metadata[_ORDER_KEY]) if _ORDER_KEY in metadata else dataset.schema.names
+    order = [col for col in order if col in dataset.schema.names]
+    if columns is not None:
+        order = [col for col in order if col in columns]
+
+    table = dataset.to_table(columns=order, filter=_filter_expression(filters))
+    if not categorical:
+        table = table.cast(pa.schema([
+            pa.field(f.name, f.type.value_type) if pa.types.is_dictionary(f.type) else f
+            for f in table.schema], metadata=table.schema.metadata))
+    return table.to_pandas()
+
+
+def export_csv(dataset_path, csv_path, columns=None, filters=None):
+    """
+    Exporte un jeu de données Parquet en CSV, pour compatibilité.
+
+    Args :
+        dataset_path (str) : Répertoire du jeu de données.
+        csv_path (str) : Chemin du CSV à écrire.
+        columns (list) : Colonnes à exporter (défaut : toutes).
+        filters (list ou ds.Expression) : Filtres (voir `read_table`).
+
+    Returns :
+        str : Chemin du CSV.
+    """
+    read_table(dataset_path, columns=columns, filters=filters).to_csv(csv_path, index=False)
+    return csv_path
+
+
+def _apply_filters(df, filters):
+    """
+    Applique des filtres au format `read_table` sur un DataFrame déjà chargé.
+
+    Args :
+        df (pd.DataFrame) : Tableau à filtrer.
+        filters (list) : Liste de tuples (ET) ou liste de listes de tuples (OU de ET).
+
+    Returns :
+        pd.DataFrame : Tableau filtré.
+    """
+    operators = {
+        '==': lambda s, v: s == v, '=': lambda s, v: s == v, '!=': lambda s, v: s != v,
+        '<': lambda s, v: s < v, '<=': lambda s, v: s <= v,
+        '>': lambda s, v: s > v, '>=': lambda s, v: s >= v,
+        'in': lambda s, v: s.isin(v), 'not in': lambda s, v: ~s.isin(v),
+    }
+    groups = filters if isinstance(filters[0], list) else [filters]
+    keep = pd.Series(False, index=df.index)
+    for group in groups:
+        mask = pd.Series(True, index=df.index)
+        for col, op, value in group:
+            mask &= operators[op](df[col], value)
+        keep |= mask
+    return df[keep]
+
+
+def load_table(path, columns=None, filters=None, categorical=False, schema=False):
+    """
+    Charge un tableau depuis son jeu de données Parquet, ou à défaut depuis son CSV.
+
+    Args :
+        path (str) : Chemin sans extension (ex. '.../tableaux/df_pixel_filtre_lidar') ;
+            le répertoire Parquet est utilisé s'il existe, sinon le fichier '.csv'.
+        columns (list) : Colonnes à charger (défaut : toutes).
+        filters (list) : Filtres (voir `read_table`) ; sous forme de liste de tuples pour
+            rester applicables au CSV.
+        categorical (bool) : Colonnes cultivar_n et source en catégories (défaut : False).
+        schema (bool) : Applique les types compacts de `SCHEMA` (défaut : False).
+
+    Returns :
+        pd.DataFrame : Tableau chargé.
+    """
+    path = path[:-4] if path.endswith('.csv') else path
+    if os.path.isdir(path):
+        df = read_table(path, columns=columns, filters=filters, categorical=categorical)
+        return apply_schema(df) if schema else df
+
+    # Repli CSV : mêmes colonnes et mêmes filtres, appliqués après lecture
+    usecols = None
+    if columns is not None:
+        needed = set(columns)
+        if filters:
+            groups = filters if isinstance(filters[0], list) else [filters]
+            needed |= {col for group in groups for col, _, _ in group}
+        usecols = lambda col: col in needed
+    df = pd.read_csv(f"{path}.csv", usecols=usecols, dtype={'id_parc': str})
+    if filters:
+        df = _apply_filters(df, filters).reset_index(drop=True)
+    if columns is not None:
+        df = df[[col for col in df.columns if col in columns]]
+    if categorical:
+        for col in ('cultivar_n', 'source'):
+            if col in df.columns:
+                df[col] = df[col].astype('category')
+    return apply_schema(df) if schema else df